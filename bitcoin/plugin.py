@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Runs the prober inside lightningd: start it with --plugin=/usr/src/app/plugin.py
+# and control it with `lightning-cli probe-start`, `probe-stop` and `probe-status`.
+# Probes are sent with sendpay and settled from sendpay_success/sendpay_failure
+# notifications, so in-flight probes do not each hold a waitsendpay call open.
+import os
+import sys
+import threading
+
+from pyln.client import Plugin
+
+plugin = Plugin()
+# lightningd talks to the plugin over stdout, so probe.py's output goes to the log
+sys.stdout = sys.stderr
+
+# probe.py reads config.ini from the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+import probe
+
+plugin.add_option('probe-interval', 0, 'Seconds from the start of one sweep to the next, 0 for a single sweep', opt_type='int')
+plugin.add_option('probe-autostart', False, 'Start probing as soon as lightningd has synchronized', opt_type='bool')
+
+sweeper = None
+base_run_id = probe.probing_run_id
+
+
+def sweep_loop(connection, run_id, interval):
+    probe.wait_for(lambda: 'warning_lightningd_sync' not in probe.l1.getinfo(), 'lightningd to synchronize')
+    if interval:
+        # Repeated sweeps only re-probe what changed, as in daemon_mode
+        probe.daemon_interval_seconds = interval
+        probe.probing_run_id = base_run_id
+        probe.run_daemon(connection, run_id)
+    else:
+        node_ids = [node['nodeid'] for node in probe.l1.listnodes()['nodes']]
+        probe.run_sweep(connection, probe.ResultWriter(connection, probe.write_batch_size, probe.write_flush_seconds), node_ids)
+    connection.close()
+
+
+def start():
+    # The run id is claimed here, so probe-start can report the run it started
+    global sweeper
+    if sweeper is not None and sweeper.is_alive():
+        return False
+    connection = probe.connect_to_database()
+    if connection is None:
+        return False
+    probe.create_table(connection)
+    # Each probe-start records a new run unless resume_run is set
+    run_id = probe.claim_run_id(connection, base_run_id, probe.resume_run)
+    probe.probing_run_id = run_id
+    probe.stop_probing.clear()
+    sweeper = threading.Thread(target=sweep_loop, args=(connection, run_id, plugin.get_option('probe-interval')), daemon=True)
+    sweeper.start()
+    return True
+
+
+@plugin.init()
+def init(options, configuration, plugin, **kwargs):
+    probe.l1 = probe.NodeRpc(os.path.join(configuration['lightning-dir'], configuration['rpc-file']))
+    probe.this_node = probe.get_this_node()
+    probe.settlements = probe.Settlements()
+    probe.start_metrics_export()
+    probe.start_event_log()
+    plugin.log(f"Prober ready on {probe.this_node}, run {base_run_id}")
+    if options['probe-autostart']:
+        start()
+
+
+@plugin.subscribe('sendpay_success')
+def on_sendpay_success(plugin, sendpay_success, **kwargs):
+    probe.settlements.resolve(sendpay_success['payment_hash'], None)
+
+
+@plugin.subscribe('sendpay_failure')
+def on_sendpay_failure(plugin, sendpay_failure, **kwargs):
+    payment_hash = (sendpay_failure.get('data') or {}).get('payment_hash')
+    if payment_hash is not None:
+        probe.settlements.resolve(payment_hash, sendpay_failure)
+
+
+@plugin.method('probe-start')
+def probe_start(plugin):
+    """Start sweeping the network, re-probing what changed every probe-interval seconds"""
+    return {'started': start(), 'run_id': probe.probing_run_id}
+
+
+@plugin.method('probe-stop')
+def probe_stop(plugin):
+    """Stop starting new probes; probes in flight still settle and are recorded"""
+    probe.stop_probing.set()
+    return {'stopping': sweeper is not None and sweeper.is_alive()}
+
+
+@plugin.method('probe-status')
+def probe_status(plugin):
+    """Show the current run, probes in flight, probe counts by failcode and the use of each of our channels"""
+    snapshot = probe.metrics.snapshot()
+    return {
+        'running': sweeper is not None and sweeper.is_alive(),
+        'run_id': probe.probing_run_id,
+        'in_flight': len(probe.settlements.expected),
+        'probes_per_second': round(snapshot['probes_per_second'], 3),
+        'results': {counter['labels'].get('failcode'): counter['value'] for counter in snapshot['counters'] if counter['name'] == 'probe_results_total'},
+        'channels': probe.htlc_slots.utilization() if probe.htlc_slots is not None else [],
+    }
+
+
+# Shard workers are spawned and import the main module again
+if __name__ == '__main__':
+    plugin.run()
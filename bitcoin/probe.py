@@ -1,15 +1,26 @@
 import sys
-from pyln.client import LightningRpc, RpcError
+from pyln.client import LightningRpc, RpcError, Millisatoshi
 import random
-import string
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import configparser
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 import json
+import gzip
+import collections
+import heapq
+import math
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import multiprocessing
 import subprocess
 import os
+import queue
+import threading
+import http.server
+import atexit
+import signal
 import requests
 import re
 
@@ -30,16 +41,105 @@ rpc_path = os.path.expanduser(config['lightning']['rpc_path'])
 
 print('RPC Set was:', rpc_path)
 
+# Optional prober nodes to shard a sweep across, one or more processes each
+shard_rpc_paths = [os.path.expanduser(path.strip()) for path in config.get('lightning', 'shard_rpc_paths', fallback='').split(',') if path.strip()]
+shard_processes_per_node = config.getint('lightning', 'shard_processes_per_node', fallback=1)
+
 table_name = config['table']['db_table_name']
+result_columns = ['run_id', 'dest', 'failcode', 'erring_node', 'erring_channel', 'route', 'time', 'amount', 'liquidity_lower_msat', 'liquidity_upper_msat', 'finished_at']
 print('Table name:', table_name)
 
 # Environment/Configuration variables
 run_full_probe = config.getboolean('settings', 'run_full_probe', fallback=False)
 probing_value_msats = config.getint('settings', 'probing_value_msats', fallback=200000000)
 probing_run_id = config['settings']['probing_run_id']
+# Startup readiness waits back off exponentially up to max_backoff_seconds
+startup_timeout_seconds = config.getint('settings', 'startup_timeout_seconds', fallback=3600)
+max_backoff_seconds = config.getint('settings', 'max_backoff_seconds', fallback=60)
+sync_wait_seconds = 60
+getinfo_ttl_seconds = 30
+# Append every lightningd RPC call and its response to this file for bench.py --replay
+rpc_trace_file = config.get('settings', 'rpc_trace_file', fallback='')
+# Probe latency metrics: Prometheus text on metrics_port, JSON in metrics_file
+metrics_port = config.getint('settings', 'metrics_port', fallback=0)
+metrics_file = config.get('settings', 'metrics_file', fallback='')
+metrics_dump_seconds = config.getint('settings', 'metrics_dump_seconds', fallback=60)
+# Structured JSON-lines events in event_log_file at event_log_level and above.
+# Per-probe traces are debug events kept at event_sample_rate; the console
+# only gets a progress line every progress_every probes.
+event_log_file = config.get('settings', 'event_log_file', fallback='')
+event_log_level = config.get('settings', 'event_log_level', fallback='info')
+event_sample_rate = config.getfloat('settings', 'event_sample_rate', fallback=0.01)
+event_flush_seconds = 1
+progress_every = config.getint('settings', 'progress_every', fallback=1000)
+# Number of probes kept in flight at once, capped below our channels' max_accepted_htlcs
+probe_concurrency = config.getint('settings', 'probe_concurrency', fallback=1)
+default_max_accepted_htlcs = 30
+# Spread probes over our channels: each probe leaves through the usable
+# channel with the most free HTLC slots, then the most in-flight amount left
+balance_first_hops = config.getboolean('settings', 'balance_first_hops', fallback=True)
+# A probe whose HTLC is unresolved after this long is recorded as TIMEOUT
+probe_timeout_seconds = config.getint('settings', 'probe_timeout_seconds', fallback=60)
+pay_in_progress_code = 200
+# Adapt concurrency and the pause between probe starts to congestion on our
+# own channels: timeouts, a first-hop TEMPORARY_CHANNEL_FAILURE rate rising
+# rate_failure_margin above its long-run level, and settle latency rising past
+# rate_latency_factor times its long-run average
+adaptive_rate = config.getboolean('settings', 'adaptive_rate', fallback=False)
+rate_min_concurrency = config.getint('settings', 'rate_min_concurrency', fallback=1)
+rate_decrease_factor = config.getfloat('settings', 'rate_decrease_factor', fallback=0.5)
+rate_failure_margin = config.getfloat('settings', 'rate_failure_margin', fallback=0.2)
+rate_latency_factor = config.getfloat('settings', 'rate_latency_factor', fallback=2.0)
+rate_max_pacing_seconds = config.getfloat('settings', 'rate_max_pacing_seconds', fallback=1.0)
+rate_pacing_step_seconds = 0.01
+# Probe rows are written in batches of this size, or after this many seconds
+write_batch_size = config.getint('settings', 'write_batch_size', fallback=500)
+write_flush_seconds = config.getfloat('settings', 'write_flush_seconds', fallback=5)
+# A batch that fails to write is retried this many times, reconnecting if the
+# connection was lost, before its rows are dropped
+write_retries = config.getint('settings', 'write_retries', fallback=5)
+# Compute routes from a local copy of listchannels, falling back to getroute
+local_routing = config.getboolean('settings', 'local_routing', fallback=True)
+max_route_hops = 20
+# Skip destinations already probed under probing_run_id
+resume_run = config.getboolean('settings', 'resume_run', fallback=False)
+# Bisect the probe amount on each route to bracket its bottleneck liquidity
+estimate_liquidity = config.getboolean('settings', 'estimate_liquidity', fallback=False)
+liquidity_precision_msats = config.getint('settings', 'liquidity_precision_msats', fallback=1000000)
+liquidity_max_probes = config.getint('settings', 'liquidity_max_probes', fallback=10)
+liquidity_max_msats = config.getint('settings', 'liquidity_max_msats', fallback=4294967295)
+# Fold each finished run into a per-channel state table, and append to the
+# channel history only the channels whose last result or liquidity bounds
+# (rounded to liquidity_precision_msats) changed since they were last probed
+channel_history = config.getboolean('settings', 'channel_history', fallback=True)
+reached_failcode = 'WIRE_INCORRECT_OR_UNKNOWN_PAYMENT_DETAILS'
+# Order of the sweep (comma separated: capacity, staleness, failures_last),
+# whether to skip nodes the channel graph cannot reach, and a time limit
+schedule_order = [policy.strip() for policy in config.get('settings', 'schedule_order', fallback='').split(',') if policy.strip()]
+skip_unreachable = config.getboolean('settings', 'skip_unreachable', fallback=True)
+sweep_budget_seconds = config.getint('settings', 'sweep_budget_seconds', fallback=0)
+# Probe one route per destination ("destinations"), or plan routes that
+# cover every channel with as few probes as possible ("channels")
+probe_plan = config.get('settings', 'probe_plan', fallback='destinations')
+coverage_max_hops = config.getint('settings', 'coverage_max_hops', fallback=10)
+# Keep running and re-probe every daemon_interval_seconds, but only new
+# destinations, ones whose last route crossed a channel with a new
+# channel_update, and ones not probed in the last freshness_seconds
+daemon_mode = config.getboolean('settings', 'daemon_mode', fallback=False)
+daemon_interval_seconds = config.getint('settings', 'daemon_interval_seconds', fallback=3600)
+freshness_seconds = config.getint('settings', 'freshness_seconds', fallback=86400)
+# Exclude recently failed channels and nodes from the routes of later probes
+use_failure_cache = config.getboolean('settings', 'failure_cache', fallback=True)
+failure_ttl_seconds = config.getint('settings', 'failure_ttl_seconds', fallback=600)
+failure_permanent_ttl_seconds = config.getint('settings', 'failure_permanent_ttl_seconds', fallback=86400)
+failure_refresh_seconds = config.getint('settings', 'failure_refresh_seconds', fallback=30)
+# BOLT 4 failure code flags
+failcode_permanent = 0x4000
+failcode_node = 0x2000
+liquidity_failcode = 'WIRE_TEMPORARY_CHANNEL_FAILURE'
 
 # Withdrawal variables (MUST BE RAN MANUALLY IN EMERGENCY)
-withdraw_now = config.get('withdrawal', 'withdraw_now', fallback=False)
+withdraw_now = config.getboolean('withdrawal', 'withdraw_now', fallback=False)
 withdrawal_address = config.get('withdrawal', 'withdrawal_address', fallback=None)
 
 # Channel variables
@@ -67,70 +167,146 @@ else:
 print('Run full probe?:', run_full_probe)
 print('Probing value:', probing_value_msats)
 print('Probing run ID:', probing_run_id)
+print('Probe concurrency:', probe_concurrency)
+print('Resume run?:', resume_run)
+print('Estimate liquidity?:', estimate_liquidity)
 print('Withdrawal address:', withdrawal_address)
 
 # Electrum seed phrase
 electrum_seed = config['wallet']['seed']
 print('Electrum seed found:', electrum_seed)
 
-# Add a check to see if /electrum/wallet exists, if it doesn't then make it
-if not os.path.exists('/electrum/wallet/'):
-    os.makedirs('/electrum/wallet/')
+def wait_for(check, description):
+    # Retry `check` with exponential backoff until it returns a truthy value
+    delay = 1
+    deadline = time.monotonic() + startup_timeout_seconds
+    while True:
+        try:
+            result = check()
+        except Exception as e:
+            print(f"Error: Checking {description} failed - {e}")
+            result = None
+        if result:
+            return result
+        if time.monotonic() >= deadline:
+            print(f"Error: Timed out waiting for {description}")
+            sys.exit(1)
+        print(f"Waiting {delay} seconds for {description}...")
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff_seconds)
 
-print('Loading electrum wallet...')
-# Recover Electrum wallet from seed
-subprocess.run(['electrum', 'restore', electrum_seed], check=True)
-print('Wallet loaded.')
+def electrum_balance():
+    result = subprocess.run(['electrum', 'getbalance'], capture_output=True, text=True, check=True)
+    if 'confirmed' in result.stdout:
+        return result.stdout
+    return None
 
-print('Loading electrum wallet...')
-# Load the wallet
-subprocess.run(['electrum', 'load_wallet',], check=True)
-print('Electrum wallet loaded..')
+class NodeRpc(LightningRpc):
+    # The one client for lightningd. pyln opens a fresh unix socket connection
+    # per call, so it is safe to share between probe threads. getinfo results
+    # are cached for getinfo_ttl_seconds for callers that only need a snapshot.
+    def __init__(self, socket_path, recorder=None):
+        super().__init__(socket_path)
+        self.info = None
+        self.info_fetched_at = 0
+        self.info_lock = threading.Lock()
+        self.recorder = recorder
 
-print('Getting info of the wallet...')
-subprocess.run(['electrum', 'getinfo'], check=True)
+    def call(self, method, payload=None, *args, **kwargs):
+        if self.recorder is None:
+            return super().call(method, payload, *args, **kwargs)
+        started = time.monotonic()
+        try:
+            result = super().call(method, payload, *args, **kwargs)
+        except RpcError as e:
+            self.recorder.write(method, payload, started, error=e.error)
+            raise
+        self.recorder.write(method, payload, started, result=result)
+        return result
 
-print('Waiting for 60 seconds...')
-time.sleep(60)
-print('Checking wallet balance...')
-# check how much is in the recovered wallet
-recovered_balance = subprocess.run(['electrum', 'getbalance'], capture_output=True, text=True, check=True)
-print('Recovered balance:', recovered_balance.stdout)
+    def cached_getinfo(self):
+        with self.info_lock:
+            if self.info is None or time.monotonic() - self.info_fetched_at > getinfo_ttl_seconds:
+                self.info = self.getinfo()
+                self.info_fetched_at = time.monotonic()
+            return self.info
 
-# recovered balance looks like this: { "confirmed": "1.06396422" }
+class TraceRecorder:
+    # Appends one compact JSON line per RPC call: start offset, duration,
+    # method, payload and either the result or the RpcError payload.
+    # Files ending in .gz are gzip-compressed.
+    def __init__(self, path):
+        self.file = gzip.open(path, 'at') if path.endswith('.gz') else open(path, 'a')
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        atexit.register(self.close)
 
-# redo check balance to see if it's updated
-print('Do we need to check the balance again? ...')
-if 'confirmed' not in recovered_balance.stdout:
-    print('Need to check for balance again...')
-else:
-    print('Dont need to check for balance again...')
-# check if there is a confirmed value in the balance
-while 'confirmed' not in recovered_balance.stdout:
-    print('Balance is 0 or non existance. waiting 60 seconds to try again')
-    time.sleep(60)
-    recovered_balance = subprocess.run(['electrum', 'getbalance'], capture_output=True, text=True, check=True)
-    print('Recovered balance:', recovered_balance.stdout)
-
-
-user_input = input("Continue? (y/n): ")
-if user_input == 'n':
-    print('Exiting script')
-    exit()
-elif user_input != 'y':
-    print('Invalid input, exiting script')
-    exit()
-else:
-    print('Continuing script')
+    def write(self, method, payload, started, result=None, error=None):
+        entry = {'t': round(started - self.started, 6), 'd': round(time.monotonic() - started, 6), 'm': method, 'p': payload}
+        if error is not None:
+            entry['e'] = error
+        else:
+            entry['r'] = result
+        line = json.dumps(entry, separators=(',', ':'), default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class ReplayRpc(NodeRpc):
+    # Serves calls from a TraceRecorder file with the recorded latencies times
+    # `speed` (0 replays instantly). getroute and sendpay are matched on their
+    # destination; waitsendpay follows the payment hash of the matched sendpay.
+    # A getroute missing from the trace is answered with the recorded sendpay route.
+    # The last response for a key is repeated once its recordings run out.
+    def __init__(self, trace_path, speed=1.0):
+        super().__init__(trace_path)
+        self.speed = speed
+        self.responses = {}
+        self.payment_hashes = {}
+        self.replay_lock = threading.Lock()
+        with (gzip.open(trace_path, 'rt') if trace_path.endswith('.gz') else open(trace_path)) as f:
+            for line in f:
+                entry = json.loads(line)
+                self.responses.setdefault(self.trace_key(entry['m'], entry['p']), collections.deque()).append(entry)
 
+    def trace_key(self, method, payload):
+        payload = payload or {}
+        if method == 'getroute':
+            return method, payload.get('id')
+        if method == 'sendpay':
+            return method, payload['route'][-1]['id']
+        if method == 'waitsendpay':
+            return method, payload.get('payment_hash')
+        return method,
+
+    def call(self, method, payload=None, *args, **kwargs):
+        with self.replay_lock:
+            if method == 'waitsendpay':
+                payload = dict(payload, payment_hash=self.payment_hashes.get(payload['payment_hash']))
+            recorded = self.responses.get(self.trace_key(method, payload))
+            if not recorded and method == 'getroute' and self.responses.get(('sendpay', payload.get('id'))):
+                # Routing choices can differ from the recording; reuse the route that was sent
+                return {'route': self.responses['sendpay', payload['id']][0]['p']['route']}
+            if not recorded:
+                raise RpcError(method, payload, {'code': -1, 'message': f"{method} is not in the trace"})
+            entry = recorded.popleft() if len(recorded) > 1 else recorded[0]
+            if method == 'sendpay':
+                self.payment_hashes[payload['payment_hash']] = entry['p']['payment_hash']
+        if self.speed:
+            time.sleep(entry['d'] * self.speed)
+        if 'e' in entry:
+            raise RpcError(method, payload, entry['e'])
+        return entry['r']
 
 def get_this_node():
     try:
-        result = subprocess.run(['lightning-cli', 'getinfo'], capture_output=True, text=True, check=True)
-        node_info = json.loads(result.stdout)
+        node_info = l1.cached_getinfo()
         print('Found a node id:', node_info['id'])
         return node_info['id']
-    except subprocess.CalledProcessError as e:
+    except RpcError as e:
         print(f"Error: Unable to get node ID - {e}")
         return None
 
@@ -147,43 +323,520 @@ def create_table(connection):
         cursor = connection.cursor()
         create_table_query = sql.SQL("""
             CREATE TABLE IF NOT EXISTS {} (
-                id SERIAL PRIMARY KEY,
+                id BIGSERIAL PRIMARY KEY,
+                run_id VARCHAR,
                 dest VARCHAR,
                 failcode VARCHAR,
                 erring_node VARCHAR,
                 erring_channel VARCHAR,
-                route VARCHAR,
-                time VARCHAR,
-                amount VARCHAR
+                route JSONB,
+                time TIMESTAMP,
+                amount BIGINT,
+                liquidity_lower_msat BIGINT,
+                liquidity_upper_msat BIGINT,
+                finished_at TIMESTAMP
             )
         """).format(sql.Identifier(table_name))
         cursor.execute(create_table_query)
+        cursor.execute(sql.SQL("""
+            ALTER TABLE {}
+                ADD COLUMN IF NOT EXISTS run_id VARCHAR,
+                ADD COLUMN IF NOT EXISTS liquidity_lower_msat BIGINT,
+                ADD COLUMN IF NOT EXISTS liquidity_upper_msat BIGINT,
+                ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP
+        """).format(sql.Identifier(table_name)))
+        # Tables from before the typed schema stored these as VARCHAR, with
+        # 'NONE' for a missing value; convert them once, 'NONE' becoming NULL
+        for column, column_type, parses in [('time', 'TIMESTAMP', "{} ~ '^[0-9]{{4}}-'"),
+                                            ('amount', 'BIGINT', "{} ~ '^-?[0-9]+$'"),
+                                            ('route', 'JSONB', "left({}, 1) = '['")]:
+            cursor.execute("SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s", (table_name, column))
+            row = cursor.fetchone()
+            if row is None or row[0] not in ('character varying', 'text'):
+                continue
+            print(f"Converting {table_name}.{column} to {column_type}...")
+            cursor.execute(sql.SQL("ALTER TABLE {table} ALTER COLUMN {column} TYPE {type} USING CASE WHEN {parses} THEN {column}::{type} END").format(
+                table=sql.Identifier(table_name), column=sql.Identifier(column), type=sql.SQL(column_type),
+                parses=sql.SQL(parses).format(sql.Identifier(column))))
+        # One row per hop of each probed route
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                run_id VARCHAR,
+                probe_id BIGINT,
+                position SMALLINT,
+                short_channel_id VARCHAR,
+                direction SMALLINT,
+                node VARCHAR,
+                amount_msat BIGINT,
+                result VARCHAR,
+                PRIMARY KEY (probe_id, position)
+            )
+        """).format(sql.Identifier(table_name + '_hops')))
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS result VARCHAR, ADD COLUMN IF NOT EXISTS direction SMALLINT").format(
+            sql.Identifier(table_name + '_hops')))
+        for table, column in [('', 'dest'), ('', 'erring_channel'), ('', 'run_id'), ('_hops', 'short_channel_id'), ('_hops', 'run_id')]:
+            cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({})").format(
+                sql.Identifier(f"{table_name}{table}_{column}_idx"), sql.Identifier(table_name + table), sql.Identifier(column)))
+        # Runs and the destinations already probed in each, so a run can resume
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                run_id VARCHAR PRIMARY KEY,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """).format(sql.Identifier(table_name + '_runs')))
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS history_folded_at TIMESTAMP").format(sql.Identifier(table_name + '_runs')))
+        # Channel state kept before it had a direction mixed both directions of
+        # each channel, so it is set aside rather than folded into
+        for suffix in ('_channels', '_channel_history'):
+            cursor.execute("""
+                SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = %(table)s)
+                   AND NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = %(table)s AND column_name = 'direction')
+            """, {'table': table_name + suffix})
+            if cursor.fetchone()[0]:
+                cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                    sql.Identifier(table_name + suffix), sql.Identifier(table_name + suffix + '_undirected')))
+                print(f"Renamed {table_name + suffix} to {table_name + suffix}_undirected, channel state is now kept per direction")
+        # Latest state of every probed channel direction, and the runs where it changed
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                short_channel_id VARCHAR,
+                direction SMALLINT,
+                run_id VARCHAR,
+                last_seen_at TIMESTAMP,
+                last_result VARCHAR,
+                liquidity_lower_msat BIGINT,
+                liquidity_upper_msat BIGINT,
+                attempts BIGINT,
+                failures BIGINT,
+                PRIMARY KEY (short_channel_id, direction)
+            )
+        """).format(sql.Identifier(table_name + '_channels')))
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                short_channel_id VARCHAR,
+                direction SMALLINT,
+                run_id VARCHAR,
+                observed_at TIMESTAMP,
+                last_result VARCHAR,
+                liquidity_lower_msat BIGINT,
+                liquidity_upper_msat BIGINT,
+                attempts BIGINT,
+                failures BIGINT,
+                PRIMARY KEY (short_channel_id, direction, run_id)
+            )
+        """).format(sql.Identifier(table_name + '_channel_history')))
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                run_id VARCHAR,
+                dest VARCHAR,
+                PRIMARY KEY (run_id, dest)
+            )
+        """).format(sql.Identifier(table_name + '_progress')))
         connection.commit()
         print("Table created successfully")
     except Exception as e:
         print(f"Error: Unable to create table - {e}")
 
-def insert_channel(connection, dest, failcode, erring_node, erring_channel, route, time, amount):
-    values = (dest, failcode, erring_node, erring_channel, route, time, amount)
+def insert_channels(connection, rows):
+    # rows are (values in result_columns order, route or None) pairs
+    write_started = time.monotonic()
     try:
         cursor = connection.cursor()
         insert_query = sql.SQL("""
-            INSERT INTO {} ({}, {}, {}, {}, {}, {}, {})
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """).format(sql.Identifier(table_name), sql.Identifier('dest'), sql.Identifier('failcode'),sql.Identifier('erring_node'),sql.Identifier('erring_channel'),sql.Identifier('route'),sql.Identifier('time'),sql.Identifier('amount'))
-        cursor.execute(insert_query, values)
+            INSERT INTO {} ({})
+            VALUES %s
+            RETURNING id
+        """).format(sql.Identifier(table_name), sql.SQL(', ').join(map(sql.Identifier, result_columns)))
+        ids = execute_values(cursor, insert_query, [values for values, _ in rows], page_size=len(rows), fetch=True)
+        hops = []
+        for (probe_id,), (values, route) in zip(ids, rows):
+            results = hop_results(route or [], values[2], values[4])
+            for position, hop in enumerate(route or []):
+                hops.append((probing_run_id, probe_id, position, hop['channel'], hop['direction'], hop['id'], to_msat(hop['amount_msat']), results[position]))
+        if hops:
+            hops_query = sql.SQL("""
+                INSERT INTO {} (run_id, probe_id, position, short_channel_id, direction, node, amount_msat, result) VALUES %s
+            """).format(sql.Identifier(table_name + '_hops'))
+            execute_values(cursor, hops_query, hops, page_size=len(hops))
+        # Checkpoint the destinations in the same transaction as their results
+        progress_query = sql.SQL("""
+            INSERT INTO {} (run_id, dest) VALUES %s
+            ON CONFLICT DO NOTHING
+        """).format(sql.Identifier(table_name + '_progress'))
+        execute_values(cursor, progress_query, [(probing_run_id, checkpoint_key(values[1], route)) for values, route in rows], page_size=len(rows))
         connection.commit()
     except Exception as e:
-        print(f"Error: Unable to insert JSON object - {e}")
+        print(f"Error: Unable to insert {len(rows)} probe rows - {e}")
+        try:
+            connection.rollback()
+        except Exception:
+            # The connection is gone; ResultWriter reconnects
+            pass
+        return False
+    metrics.observe('db_write_seconds', time.monotonic() - write_started)
+    metrics.increment('db_rows_written_total', len(rows))
+    return True
+
+def hop_results(route, failcode, erring_channel):
+    # What a probe tells us about each hop: PASSED for every channel it got
+    # through, its failcode for erring_channel, and nothing past that
+    if failcode == reached_failcode:
+        return ['PASSED'] * len(route)
+    results = [None] * len(route)
+    for position, hop in enumerate(route):
+        if hop['channel'] == erring_channel:
+            results[:position] = ['PASSED'] * position
+            results[position] = failcode
+            break
+    return results
 
-def get_lightning_blockheight():
+def claim_run_id(connection, base_run_id, resume=False):
+    # base_run_id if no run has used it (or it is being resumed), else the
+    # next free base_run_id-N, so a sweep never adds rows to an earlier run
+    if resume:
+        return base_run_id
     try:
-        result = subprocess.run(['lightning-cli', 'getinfo'], capture_output=True, text=True, check=True)
-        node_info = json.loads(result.stdout)
-        return node_info['blockheight']
-    except subprocess.CalledProcessError as e:
-        print(f"Error: Unable to get block height - {e}")
-        return None
+        cursor = connection.cursor()
+        cursor.execute(sql.SQL("SELECT run_id FROM {} WHERE run_id = %s OR run_id LIKE %s").format(sql.Identifier(table_name + '_runs')),
+                       (base_run_id, f"{base_run_id}-%"))
+        used = {run_id for run_id, in cursor.fetchall()}
+    except Exception as e:
+        print(f"Error: Unable to look up earlier runs - {e}")
+        connection.rollback()
+        return f"{base_run_id}-{int(time.time())}"
+    run_id = base_run_id
+    suffix = 1
+    while run_id in used:
+        suffix += 1
+        run_id = f"{base_run_id}-{suffix}"
+    if run_id != base_run_id:
+        print(f"Run {base_run_id} already exists, recording this sweep as {run_id}")
+    return run_id
+
+def start_run(connection):
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql.SQL("""
+            INSERT INTO {} (run_id, started_at) VALUES (%s, NOW())
+            ON CONFLICT (run_id) DO NOTHING
+        """).format(sql.Identifier(table_name + '_runs')), (probing_run_id,))
+        connection.commit()
+    except Exception as e:
+        print(f"Error: Unable to record run - {e}")
+        connection.rollback()
+
+def finish_run(connection):
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql.SQL("UPDATE {} SET finished_at = NOW() WHERE run_id = %s").format(sql.Identifier(table_name + '_runs')), (probing_run_id,))
+        connection.commit()
+    except Exception as e:
+        print(f"Error: Unable to mark run finished - {e}")
+        connection.rollback()
+
+def fold_channel_history(connection):
+    # Fold this run's hop results into the channel state table once, and
+    # record a history entry for each channel direction whose state changed.
+    # Liquidity is per direction: its bounds are the largest amount it
+    # forwarded (or that a bisected route carried) and the smallest amount it
+    # failed with liquidity_failcode.
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql.SQL("UPDATE {} SET history_folded_at = NOW() WHERE run_id = %s AND history_folded_at IS NULL").format(
+            sql.Identifier(table_name + '_runs')), (probing_run_id,))
+        if cursor.rowcount == 0:
+            connection.rollback()
+            return
+        cursor.execute(sql.SQL("""
+            CREATE TEMPORARY TABLE observed ON COMMIT DROP AS
+            SELECT short_channel_id, direction, attempts, failures, last_result,
+                   lower / %(precision)s * %(precision)s AS liquidity_lower_msat,
+                   (upper + %(precision)s - 1) / %(precision)s * %(precision)s AS liquidity_upper_msat
+            FROM (
+                SELECT h.short_channel_id, h.direction,
+                       COUNT(*) AS attempts,
+                       COUNT(*) FILTER (WHERE h.result <> 'PASSED') AS failures,
+                       (ARRAY_AGG(h.result ORDER BY h.probe_id DESC))[1] AS last_result,
+                       MAX(GREATEST(CASE WHEN h.result = 'PASSED' THEN h.amount_msat END, p.liquidity_lower_msat)) AS lower,
+                       MIN(CASE WHEN h.result = %(liquidity_failcode)s THEN h.amount_msat END) AS upper
+                FROM {} h JOIN {} p ON p.id = h.probe_id
+                WHERE h.run_id = %(run_id)s AND h.result IS NOT NULL AND h.direction IS NOT NULL
+                GROUP BY h.short_channel_id, h.direction
+            ) run
+        """).format(sql.Identifier(table_name + '_hops'), sql.Identifier(table_name)),
+            {'precision': liquidity_precision_msats, 'liquidity_failcode': liquidity_failcode, 'run_id': probing_run_id})
+        cursor.execute(sql.SQL("""
+            INSERT INTO {} (short_channel_id, direction, run_id, observed_at, last_result, liquidity_lower_msat, liquidity_upper_msat, attempts, failures)
+            SELECT o.short_channel_id, o.direction, %s, NOW(), o.last_result, o.liquidity_lower_msat, o.liquidity_upper_msat,
+                   COALESCE(c.attempts, 0) + o.attempts, COALESCE(c.failures, 0) + o.failures
+            FROM observed o LEFT JOIN {} c USING (short_channel_id, direction)
+            WHERE c.short_channel_id IS NULL
+               OR (o.last_result, o.liquidity_lower_msat, o.liquidity_upper_msat) IS DISTINCT FROM (c.last_result, c.liquidity_lower_msat, c.liquidity_upper_msat)
+            ON CONFLICT DO NOTHING
+        """).format(sql.Identifier(table_name + '_channel_history'), sql.Identifier(table_name + '_channels')), (probing_run_id,))
+        changed = cursor.rowcount
+        cursor.execute(sql.SQL("""
+            INSERT INTO {table} AS c (short_channel_id, direction, run_id, last_seen_at, last_result, liquidity_lower_msat, liquidity_upper_msat, attempts, failures)
+            SELECT short_channel_id, direction, %s, NOW(), last_result, liquidity_lower_msat, liquidity_upper_msat, attempts, failures FROM observed
+            ON CONFLICT (short_channel_id, direction) DO UPDATE SET
+                run_id = EXCLUDED.run_id,
+                last_seen_at = EXCLUDED.last_seen_at,
+                last_result = EXCLUDED.last_result,
+                liquidity_lower_msat = EXCLUDED.liquidity_lower_msat,
+                liquidity_upper_msat = EXCLUDED.liquidity_upper_msat,
+                attempts = c.attempts + EXCLUDED.attempts,
+                failures = c.failures + EXCLUDED.failures
+        """).format(table=sql.Identifier(table_name + '_channels')), (probing_run_id,))
+        observed = cursor.rowcount
+        connection.commit()
+        print(f"Channel history: {observed} channel directions observed, {changed} changed")
+    except Exception as e:
+        print(f"Error: Unable to update channel history - {e}")
+        connection.rollback()
+
+def checkpoint_key(destination, route):
+    # A planned sweep sends several routes to one destination, so each is
+    # checkpointed by the channel it ends with instead
+    if planned_checkpoints and route:
+        return f"{route[-1]['channel']}/{route[-1]['direction']}"
+    return destination
+
+def get_completed_destinations(connection):
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql.SQL("SELECT dest FROM {} WHERE run_id = %s").format(sql.Identifier(table_name + '_progress')), (probing_run_id,))
+        return {row[0] for row in cursor.fetchall()}
+    except Exception as e:
+        print(f"Error: Unable to load run progress - {e}")
+        connection.rollback()
+        return set()
+
+class ResultWriter:
+    # Buffers probe rows and writes them from a background thread in multi-row
+    # inserts, so probing never waits on the database. Failed batches are
+    # retried; if the thread dies anyway, add() raises instead of queueing rows
+    # that will never be written.
+    def __init__(self, connection, batch_size, flush_interval):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, row):
+        if not self.thread.is_alive():
+            raise RuntimeError(f"Result writer is not running - {self.error or 'closed'}")
+        self.queue.put(row)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        elif not self.closed:
+            print(f"Error: Result writer died, {self.queue.qsize()} probe rows were not written - {self.error}")
+        self.closed = True
+
+    def _write(self, rows):
+        delay = 1
+        for attempt in range(write_retries + 1):
+            if insert_channels(self.connection, rows):
+                return
+            if attempt == write_retries:
+                break
+            if getattr(self.connection, 'closed', 0):
+                print('Reconnecting to the database')
+                self.connection = connect_to_database() or self.connection
+            time.sleep(delay)
+            delay = min(delay * 2, max_backoff_seconds)
+        print(f"Error: Dropping {len(rows)} probe rows after {write_retries + 1} failed writes")
+        metrics.increment('db_rows_dropped_total', len(rows))
+
+    def _run(self):
+        try:
+            self._flush_loop()
+        except Exception as e:
+            self.error = e
+            print(f"Error: Result writer stopped - {e}")
+
+    def _flush_loop(self):
+        rows = []
+        last_flush = time.monotonic()
+        closing = False
+        while not closing:
+            timeout = max(self.flush_interval - (time.monotonic() - last_flush), 0)
+            try:
+                row = self.queue.get(timeout=timeout)
+                if row is None:
+                    closing = True
+                else:
+                    rows.append(row)
+            except queue.Empty:
+                pass
+            if closing or len(rows) >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                if rows:
+                    self._write(rows)
+                    rows = []
+                last_flush = time.monotonic()
+
+class Metrics:
+    # Latency histograms and outcome counters, exported in the Prometheus text
+    # format on metrics_port and as a JSON snapshot in metrics_file
+    buckets = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.monotonic()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(self.buckets) + [0, 0.0]
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[position] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def probes_per_second(self):
+        with self.lock:
+            probes = sum(value for (name, _), value in self.counters.items() if name == 'probe_results_total')
+        return probes / max(time.monotonic() - self.started, 1e-9)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for position, bound in enumerate(self.buckets):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {histogram[position]}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram[-2]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram[-1]:.6f}")
+        lines.append(f"probes_per_second {self.probes_per_second():.3f}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        probes_per_second = self.probes_per_second()
+        with self.lock:
+            return {
+                'elapsed_seconds': time.monotonic() - self.started,
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()],
+                'histograms': [{'name': name, 'labels': dict(labels), 'buckets': dict(zip(self.buckets, histogram[:-2])), 'count': histogram[-2], 'sum': histogram[-1]}
+                               for (name, labels), histogram in self.histograms.items()],
+                'probes_per_second': probes_per_second,
+            }
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def dump_metrics():
+    with open(metrics_file + '.tmp', 'w') as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(metrics_file + '.tmp', metrics_file)
+
+def start_metrics_export():
+    if metrics_port:
+        server = http.server.ThreadingHTTPServer(('', metrics_port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print('Serving metrics on port', metrics_port)
+    if metrics_file:
+        def dump_periodically():
+            while True:
+                time.sleep(metrics_dump_seconds)
+                dump_metrics()
+        threading.Thread(target=dump_periodically, daemon=True).start()
+        atexit.register(dump_metrics)
+        print('Writing metrics to', metrics_file)
+
+metrics = Metrics()
+
+class EventLog:
+    # JSON-lines events formatted and written from a background thread, so a
+    # probe only pays for a queue put. Events below the configured level are
+    # dropped before any formatting, and sampled ones are kept at sample_rate.
+    # Nothing is logged until start().
+    levels = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+    def __init__(self):
+        self.threshold = None
+        self.sample_rate = 1.0
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self, path, level, sample_rate):
+        self.file = open(path, 'a')
+        self.threshold = self.levels[level]
+        self.sample_rate = sample_rate
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def enabled(self, level, sampled=False):
+        if self.threshold is None or self.levels[level] < self.threshold:
+            return False
+        return not sampled or random.random() < self.sample_rate
+
+    def emit(self, level, event, sampled=False, **fields):
+        if self.enabled(level, sampled):
+            self.queue.put((time.time(), level, event, probing_run_id, fields))
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                entry = self.queue.get(timeout=event_flush_seconds)
+            except queue.Empty:
+                entry = ()
+            if entry is None:
+                break
+            if entry:
+                at, level, event, run_id, fields = entry
+                line = json.dumps({'time': round(at, 6), 'level': level, 'event': event, 'run_id': run_id, **fields}, separators=(',', ':'), default=str)
+                self.file.write(line + '\n')
+            if time.monotonic() - last_flush >= event_flush_seconds:
+                self.file.flush()
+                last_flush = time.monotonic()
+        self.file.close()
+
+def start_event_log(path=None):
+    if event_log_file:
+        events.start(path or event_log_file, event_log_level, event_sample_rate)
+        print('Writing events to', path or event_log_file)
+
+events = EventLog()
 
 def get_latest_blockheight():
     network = config.get('settings', 'network', fallback='mainnet')
@@ -204,148 +857,1147 @@ def get_latest_blockheight():
         print(f"Error: Unable to get latest block height - {e}")
         return None
 
-def is_synchronized():
-    lightning_blockheight = get_lightning_blockheight()
-    latest_blockheight = get_latest_blockheight()
+def reached_blockheight(blockheight):
+    # lightningd returns as soon as it reaches the height, or errors on timeout
+    try:
+        l1.waitblockheight(blockheight, sync_wait_seconds)
+        return True
+    except RpcError as e:
+        print(f"lightningd has not reached block {blockheight} yet - {e.error.get('message')}")
+        return False
 
-    if lightning_blockheight and latest_blockheight:
-        print(f"Lightning block height: {lightning_blockheight}, Latest block height: {latest_blockheight}")
-        return lightning_blockheight >= latest_blockheight - 1
-    return False
+class RateController:
+    # Additive increase, multiplicative decrease. Each uncongested result adds
+    # 1/limit to the limit (one probe per round of results); a congested one
+    # cuts it by rate_decrease_factor, and results of probes sent before a cut
+    # are ignored. Below the minimum limit, probe starts are spaced out by a
+    # pause that doubles on congestion and halves again before the limit grows.
+    # First-hop failures are compared with their own long-run rate, since
+    # channels short of balance fail that way all the time.
+    def __init__(self, maximum):
+        self.maximum = maximum
+        # At least one probe stays in flight, or run_probes would wait on nothing
+        self.minimum = max(min(rate_min_concurrency, maximum), 1)
+        self.limit = float(maximum)
+        self.pacing = 0.0
+        self.latency = None
+        self.samples = 0
+        self.baseline = None
+        self.failure_rate = 0.0
+        self.failure_baseline = 0.0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
 
-print('Checking if lightningd is synchronized...')
-while not is_synchronized():
-    print('Not yet synchronized, waiting 30 seconds...')
-    time.sleep(30)
+    def congestion(self, error):
+        if error.get('failcodename') == 'TIMEOUT':
+            return 'timeout'
+        if self.failure_rate > self.failure_baseline + rate_failure_margin:
+            return f"{self.failure_rate:.0%} first-hop failures"
+        if self.samples >= 10 and self.latency > self.baseline * rate_latency_factor:
+            return f"{self.latency:.2f}s settle latency"
+        return None
 
-print('lightningd is synchronized')
+    def observe(self, route, error, seconds):
+        first_hop_failure = error.get('failcodename') == 'WIRE_TEMPORARY_CHANNEL_FAILURE' and error.get('erring_channel') == route[0]['channel']
+        now = time.monotonic()
+        with self.lock:
+            if now - seconds < self.last_decrease:
+                # Sent before the last cut, so it says nothing about the new limit
+                return
+            # Mean of the first ten settles, then a moving average; it only
+            # counts towards congestion once it has seen all ten. The baseline
+            # moves a tenth as fast, so only a sudden rise stands out.
+            self.samples += 1
+            self.latency = seconds if self.latency is None else self.latency + (seconds - self.latency) / min(self.samples, 10)
+            if self.samples >= 10:
+                self.baseline = self.latency if self.baseline is None else 0.99 * self.baseline + 0.01 * seconds
+            self.failure_rate = 0.95 * self.failure_rate + 0.05 * first_hop_failure
+            self.failure_baseline = 0.995 * self.failure_baseline + 0.005 * first_hop_failure
+            reason = self.congestion(error)
+            if reason is not None:
+                self.last_decrease = now
+                self.latency = None
+                self.samples = 0
+                self.failure_rate = self.failure_baseline
+                if self.limit > self.minimum:
+                    self.limit = max(self.limit * rate_decrease_factor, self.minimum)
+                else:
+                    self.pacing = min(max(self.pacing * 2, rate_pacing_step_seconds), rate_max_pacing_seconds)
+                metrics.increment('rate_decreases_total')
+                print(f"Congestion ({reason}): {int(self.limit)} probes in flight, {self.pacing:.2f}s between probes")
+            elif self.pacing:
+                self.pacing = self.pacing / 2 if self.pacing > rate_pacing_step_seconds else 0.0
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
 
-this_node = get_this_node()
-print('This node:', this_node)
+    def window(self):
+        with self.lock:
+            return int(self.limit), self.pacing
 
-print('Connecting to database')
-connection = connect_to_database()
-    
-if connection:
-    print('Connected to database')
-    print('Creating table')
-    create_table(connection)
+def get_our_channels():
+    # Our normal channels by short_channel_id, with their peer, direction, HTLC
+    # slots (kept below the peer's max_accepted_htlcs) and the amount we can
+    # have in flight on them; None when unknown
+    try:
+        channels = l1.listpeerchannels()['channels']
+    except RpcError as e:
+        print(f"Error: Unable to list peer channels - {e}")
+        return None
+    ours = {}
+    for channel in channels:
+        if channel.get('state') != 'CHANNELD_NORMAL' or 'short_channel_id' not in channel:
+            continue
+        spendable = to_msat(channel.get('spendable_msat', 0))
+        if 'their_max_htlc_value_in_flight_msat' in channel:
+            spendable = min(spendable, to_msat(channel['their_max_htlc_value_in_flight_msat']))
+        ours[channel['short_channel_id']] = {
+            'peer_id': channel['peer_id'],
+            'direction': channel.get('direction', 0 if this_node < channel['peer_id'] else 1),
+            'slots': max(channel.get('max_accepted_htlcs', default_max_accepted_htlcs) - 1, 0),
+            'in_flight_msat': spendable,
+        }
+    return ours
 
+def get_channel_limits(channels):
+    # HTLC slots and in-flight amount across `channels`; None when unknown
+    if channels is None:
+        return 1, None
+    return max(sum(channel['slots'] for channel in channels.values()), 1), sum(channel['in_flight_msat'] for channel in channels.values())
 
-print('Trying to find LightningRPC at:', rpc_path)
-l1 = LightningRpc(rpc_path)
+def get_htlc_window(requested, slots):
+    # Keep the number of in-flight probes below what our channels will accept
+    window = max(min(requested, slots), 1)
+    if window < requested:
+        print(f"Capping concurrency at {window} (requested {requested})")
+    return window
 
+class HtlcSlots:
+    # Outstanding probe HTLCs on our channels. A probe waits for a free slot
+    # and enough in-flight amount before sendpay, in total and on its first-hop
+    # channel when that is one of `channels` (from get_our_channels). HTLCs
+    # whose waitsendpay timed out keep their slot until listsendpays shows they
+    # are no longer pending. A stuck HTLC is already older than the timeout, so
+    # it is checked as soon as a probe is waiting, then every
+    # probe_timeout_seconds while it stays pending.
+    def __init__(self, slots, max_in_flight_msat, channels=None):
+        self.slots = slots
+        self.max_in_flight_msat = max_in_flight_msat
+        self.pending = {}
+        self.stuck = {}
+        self.reconciling = False
+        self.condition = threading.Condition()
+        self.channels = channels or {}
+        self.channel_pending = {short_channel_id: {} for short_channel_id in self.channels}
+        self.first_hops = {}
+        self.sent = collections.Counter()
+        self.peak = collections.Counter()
 
-print('l1 is equal to:', l1)
-print('Trying to get list of nodes')
-nodes = l1.listnodes()
+    def full(self, amount_msat, channel=None):
+        if len(self.pending) >= self.slots:
+            return True
+        if self.max_in_flight_msat and self.pending and sum(self.pending.values()) + amount_msat > self.max_in_flight_msat:
+            return True
+        if channel in self.channels:
+            pending = self.channel_pending[channel]
+            if len(pending) >= max(self.channels[channel]['slots'], 1):
+                return True
+            return bool(pending) and sum(pending.values()) + amount_msat > self.channels[channel]['in_flight_msat']
+        return False
 
-print('Num Nodes: ' + str(len(nodes['nodes'])))
+    def headroom(self, channel, amount_msat):
+        # Whether one of our channels can take amount_msat now, then its free
+        # HTLC slots and in-flight amount
+        free_msat = self.channels[channel]['in_flight_msat'] - sum(self.channel_pending[channel].values())
+        free_slots = self.channels[channel]['slots'] - len(self.channel_pending[channel])
+        return free_slots > 0 and free_msat >= amount_msat, free_slots, free_msat
 
-funds = l1.listfunds()
-# connect to a initial node
-print('Funds available:', funds)
+    def stuck_full(self, channel, amount_msat):
+        # Whether a channel is full only because of HTLCs whose waitsendpay
+        # timed out, which may hold it for much longer than a probe
+        if self.headroom(channel, amount_msat)[0]:
+            return False
+        live = [amount for payment_hash, amount in self.channel_pending[channel].items() if payment_hash not in self.stuck]
+        return len(live) < self.channels[channel]['slots'] and sum(live) + amount_msat <= self.channels[channel]['in_flight_msat']
 
-# Generate a new payment address
-paymentAddress = l1.newaddr()
-print('Payment Address:', paymentAddress)
+    def choose(self, channels, amount_msat):
+        with self.condition:
+            usable = [channel for channel in channels if not self.stuck_full(channel, amount_msat)] or list(channels)
+            # Rank by how many more probes of amount_msat fit, so a channel
+            # with few in flight but room for only one is not everyone's pick
+            return max(usable, key=lambda channel: self.capacity(channel, amount_msat))
 
-# Send payment to the new address
-amount_btc = "0.001"  # specify the amount to send in BTC
-subprocess.run(['electrum', 'payto', paymentAddress, amount_btc, '--wallet', '/electrum/wallet'], check=True)
+    def capacity(self, channel, amount_msat):
+        fits, free_slots, free_msat = self.headroom(channel, amount_msat)
+        return fits, min(free_slots, free_msat // max(amount_msat, 1)), free_msat
 
-print('Connecting to intial node')
-# connect to a intial node
-connect = l1.connect(initial_channel_node_id, initial_channel_host, initial_channel_port)
-print('Connected to initial node')
+    def utilization(self):
+        with self.condition:
+            return [{
+                'short_channel_id': short_channel_id,
+                'peer_id': channel['peer_id'],
+                'probes': self.sent[short_channel_id],
+                'in_flight': len(self.channel_pending[short_channel_id]),
+                'peak_in_flight': self.peak[short_channel_id],
+                'slots': channel['slots'],
+            } for short_channel_id, channel in self.channels.items()]
 
-peers = l1.listpeers()
-print('List Peers:', peers)
+    def acquire(self, payment_hash, amount_msat, channel=None):
+        with self.condition:
+            while self.full(amount_msat, channel):
+                # Releases on other channels keep waking us, so stuck HTLCs are
+                # checked on their own deadlines rather than after an idle wait
+                due = min(self.stuck.values(), default=None)
+                now = time.monotonic()
+                if due is not None and due <= now and not self.reconciling:
+                    self.reconciling = True
+                    self.condition.release()
+                    try:
+                        self.reconcile(now)
+                    finally:
+                        self.condition.acquire()
+                        self.reconciling = False
+                        self.condition.notify_all()
+                    continue
+                timeout = probe_timeout_seconds
+                if due is not None and not self.reconciling:
+                    timeout = min(max(due - now, 0), timeout)
+                self.condition.wait(timeout=timeout)
+            self.pending[payment_hash] = amount_msat
+            if channel in self.channels:
+                self.first_hops[payment_hash] = channel
+                self.channel_pending[channel][payment_hash] = amount_msat
+                self.sent[channel] += 1
+                self.peak[channel] = max(self.peak[channel], len(self.channel_pending[channel]))
 
-print('Starting main loop')
-total_nodes = 2701
-counter = 0
-if run_full_probe:
-    print('Check if the node is funded...')
-    if funds['channels'] == []:
-        print('Node is not funded. Exiting...')
-        sys.exit(1)
-    else:
-        print('Node is funded. Continuing...')
-        print('Going through nodes...', len(nodes['nodes']))
-        for node in nodes['nodes']:
+    def release(self, payment_hash):
+        with self.condition:
+            self.pending.pop(payment_hash, None)
+            self.stuck.pop(payment_hash, None)
+            channel = self.first_hops.pop(payment_hash, None)
+            if channel is not None:
+                self.channel_pending[channel].pop(payment_hash, None)
+            self.condition.notify_all()
 
-            counter = counter + 1
-            print('Counter:', counter)
+    def mark_stuck(self, payment_hash):
+        with self.condition:
+            self.stuck[payment_hash] = time.monotonic()
+            stuck = len(self.stuck)
+            self.condition.notify_all()
+        events.emit('warning', 'probe_timeout', payment_hash=payment_hash, stuck=stuck)
+
+    def reconcile(self, now):
+        # Release the stuck HTLCs due by `now` that are no longer pending
+        with self.condition:
+            due = [payment_hash for payment_hash, deadline in self.stuck.items() if deadline <= now]
+        for payment_hash in due:
+            try:
+                payments = l1.listsendpays(payment_hash=payment_hash)['payments']
+            except RpcError as e:
+                print(f"Error: Unable to check pending probe {payment_hash} - {e}")
+                payments = [{'status': 'pending'}]
+            if all(payment['status'] != 'pending' for payment in payments):
+                self.release(payment_hash)
+                continue
+            with self.condition:
+                if payment_hash in self.stuck:
+                    self.stuck[payment_hash] = time.monotonic() + probe_timeout_seconds
+
+
+class ChannelGraph:
+    # Compact adjacency index over one listchannels snapshot. Node ids are kept
+    # as 33-byte keys mapped to integer indexes, and each directed channel is a
+    # tuple keyed by its source node, so one Dijkstra pass routes to every node.
+    def __init__(self):
+        self.node_index = {}
+        self.node_ids = []
+        self.edges = []
+        self.channels = {}
+        self.tree = {}
+        self.tree_amount = None
+        self.tree_excluded = frozenset()
+        self.tree_built = 0
+        # For each peer of the source, a tree whose routes all leave through it
+        self.peer_trees = {}
+
+    def _index(self, node_id):
+        key = bytes.fromhex(node_id)
+        index = self.node_index.get(key)
+        if index is None:
+            index = len(self.node_ids)
+            self.node_index[key] = index
+            self.node_ids.append(key)
+            self.edges.append([])
+        return index
+
+    def index_of(self, node_id):
+        return self.node_index.get(bytes.fromhex(node_id))
 
-            print(node['nodeid'])
-            print()
+    def node_id(self, index):
+        return self.node_ids[index].hex()
 
-            if node['nodeid'] == this_node:
+    def add_channel(self, source, destination, short_channel_id, direction, base_fee, fee_ppm, delay, htlc_min, htlc_max):
+        edge = (self._index(destination), sys.intern(short_channel_id), direction, base_fee, fee_ppm, delay, htlc_min, htlc_max)
+        self.edges[self._index(source)].append(edge)
+        self.channels[edge[1], direction] = (self.index_of(source), edge)
+
+    def compute_tree(self, source, amount_msat, excluded=frozenset(), per_peer=False):
+        # Fees are estimated on the probe amount; exact per-hop amounts are
+        # worked out backwards from the destination in route(). `excluded`
+        # takes getroute-style "scid/direction" and node id entries. With
+        # per_peer, also builds peer_trees, one Dijkstra pass per peer.
+        self.tree_amount = amount_msat
+        self.tree_excluded = excluded
+        self.tree_built = time.monotonic()
+        start = self.index_of(source)
+        if start is None:
+            self.tree = {}
+            self.peer_trees = {}
+            return
+        excluded_channels = set()
+        excluded_nodes = set()
+        for entry in excluded:
+            if '/' in entry:
+                short_channel_id, direction = entry.split('/')
+                excluded_channels.add((short_channel_id, int(direction)))
+            elif self.index_of(entry) is not None:
+                excluded_nodes.add(self.index_of(entry))
+        self.tree = self.shortest_paths(start, amount_msat, excluded_channels, excluded_nodes)
+        peer_trees = {}
+        peers = {edge[0] for edge in self.edges[start]}
+        if per_peer and len(peers) > 1:
+            for peer in peers:
+                others = {(edge[1], edge[2]) for edge in self.edges[start] if edge[0] != peer}
+                peer_trees[peer] = self.shortest_paths(start, amount_msat, excluded_channels | others, excluded_nodes)
+        self.peer_trees = peer_trees
+
+    def shortest_paths(self, start, amount_msat, excluded_channels, excluded_nodes):
+        tree = {}
+        costs = {start: 0}
+        hops = {start: 0}
+        heap = [(0, start)]
+        while heap:
+            cost, current = heapq.heappop(heap)
+            if cost > costs[current] or hops[current] >= max_route_hops:
                 continue
+            for edge in self.edges[current]:
+                target, short_channel_id, direction, base_fee, fee_ppm, _, htlc_min, htlc_max = edge
+                if amount_msat < htlc_min or amount_msat > htlc_max:
+                    continue
+                if target in excluded_nodes or (short_channel_id, direction) in excluded_channels:
+                    continue
+                fee = 0 if current == start else base_fee + amount_msat * fee_ppm // 1000000
+                new_cost = cost + fee + 1
+                if new_cost < costs.get(target, new_cost + 1):
+                    costs[target] = new_cost
+                    hops[target] = hops[current] + 1
+                    tree[target] = (current, edge)
+                    heapq.heappush(heap, (new_cost, target))
+        return tree
 
-            probe = {
-                'destination': node['nodeid'],
-                'started_at': str(datetime.now()),
-                'node': node
-            }
+    def path(self, target, tree=None):
+        # Edges of the tree path to node index `target`
+        tree = self.tree if tree is None else tree
+        path = []
+        while target in tree:
+            previous, edge = tree[target]
+            path.append(edge)
+            target = previous
+        path.reverse()
+        return path
+
+    def route(self, destination, amount_msat, final_cltv=9):
+        target = self.index_of(destination)
+        if target not in self.tree:
+            return None
+        return self.build_route(self.path(target), amount_msat, final_cltv)
+
+    def route_through(self, edge, destination, amount_msat, final_cltv=9):
+        # Route leaving through our channel `edge`, then along its peer's tree
+        tree = self.peer_trees.get(edge[0])
+        target = self.index_of(destination)
+        if tree is None or target not in tree:
+            return None
+        return self.build_route([edge] + self.path(target, tree)[1:], amount_msat, final_cltv)
+
+    def plan_coverage(self, source, amount_msat, max_hops, targets):
+        # Greedy set cover of the `targets` channels: every tree path extended
+        # by one more channel is a candidate, and the one crossing the most
+        # uncovered targets is taken next. Scores only go down, so candidates
+        # are re-scored lazily when they reach the top of the heap. A taken
+        # path keeps going through uncovered targets up to max_hops.
+        start = self.index_of(source)
+        if start is None:
+            return []
+        candidates = []
+        for index in [start, *self.tree]:
+            path = self.path(index)
+            if len(path) >= max_hops:
+                continue
+            visited = {start, *(edge[0] for edge in path)}
+            for edge in self.edges[index]:
+                if edge[0] not in visited and edge[6] <= amount_msat <= edge[7]:
+                    candidates.append((-(len(path) + 1), len(candidates), index, edge))
+        heapq.heapify(candidates)
+        covered = set()
+        paths = []
+        while candidates:
+            _, order, index, edge = heapq.heappop(candidates)
+            path = self.path(index) + [edge]
+            gain = sum(1 for hop in path if (hop[1], hop[2]) in targets and (hop[1], hop[2]) not in covered)
+            if not gain:
+                continue
+            if candidates and gain < -candidates[0][0]:
+                heapq.heappush(candidates, (-gain, order, index, edge))
+                continue
+            covered.update((hop[1], hop[2]) for hop in path)
+            visited = {start, *(hop[0] for hop in path)}
+            while len(path) < max_hops:
+                for hop in self.edges[path[-1][0]]:
+                    key = (hop[1], hop[2])
+                    if key in targets and key not in covered and hop[0] not in visited and hop[6] <= amount_msat <= hop[7]:
+                        break
+                else:
+                    break
+                path.append(hop)
+                covered.add(key)
+                visited.add(hop[0])
+            paths.append(path)
+        return paths
+
+    def build_route(self, path, amount_msat, final_cltv=9):
+        # Each hop carries what the next node must forward plus that node's fee
+        route = []
+        amount = amount_msat
+        delay = final_cltv
+        for position in range(len(path) - 1, -1, -1):
+            target, short_channel_id, direction, _, _, _, _, _ = path[position]
+            route.append({
+                'id': self.node_id(target),
+                'channel': short_channel_id,
+                'direction': direction,
+                'amount_msat': amount,
+                'delay': delay,
+                'style': 'tlv'
+            })
+            if position > 0:
+                _, _, _, base_fee, fee_ppm, cltv_delta, _, _ = path[position]
+                amount += base_fee + amount * fee_ppm // 1000000
+                delay += cltv_delta
+        route.reverse()
+        return route
+
+def to_msat(value):
+    return int(Millisatoshi(value))
+
+def load_channel_graph():
+    graph = ChannelGraph()
+    ours = {(channel['short_channel_id'], channel['direction']): channel for channel in l1.listpeerchannels()['channels']
+            if channel.get('state') == 'CHANNELD_NORMAL' and 'short_channel_id' in channel}
+    for channel in l1.listchannels()['channels']:
+        if not channel.get('active', True):
+            continue
+        direction = channel.get('direction', 0 if channel['source'] < channel['destination'] else 1)
+        htlc_max = to_msat(channel.get('htlc_maximum_msat', channel['amount_msat']))
+        if channel['source'] == this_node:
+            # Our side of a channel can only send what is spendable, whatever its gossip says
+            if (channel['short_channel_id'], direction) not in ours:
+                continue
+            htlc_max = min(htlc_max, to_msat(ours[channel['short_channel_id'], direction]['spendable_msat']))
+        graph.add_channel(channel['source'], channel['destination'], channel['short_channel_id'], direction,
+                          channel['base_fee_millisatoshi'], channel['fee_per_millionth'], channel['delay'],
+                          to_msat(channel['htlc_minimum_msat']), htlc_max)
+    # Our own channels may be unannounced, so add them from listpeerchannels
+    for key, channel in ours.items():
+        if key in graph.channels:
+            continue
+        graph.add_channel(this_node, channel['peer_id'], channel['short_channel_id'], channel['direction'],
+                          0, 0, 0, 0, to_msat(channel['spendable_msat']))
+    graph.compute_tree(this_node, probing_value_msats, per_peer=balance_first_hops)
+    print(f"Channel graph: {len(graph.node_ids)} nodes, {len(graph.channels)} directed channels, {len(graph.tree)} reachable")
+    return graph
+
+class FailureCache:
+    # Channels and nodes that recently failed a probe, kept as getroute
+    # exclusions until their TTL runs out. Permanent failures are kept longer.
+    def __init__(self, ttl, permanent_ttl):
+        self.ttl = ttl
+        self.permanent_ttl = permanent_ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, error):
+        failcode = error.get('failcode')
+        if failcode is None or error.get('failcodename') == reached_failcode or error.get('erring_node') == this_node:
+            return
+        if failcode & failcode_node:
+            entry = error.get('erring_node')
+        elif error.get('erring_channel') is not None:
+            entry = f"{error['erring_channel']}/{error.get('erring_direction', 0)}"
+        else:
+            return
+        ttl = self.permanent_ttl if failcode & failcode_permanent else self.ttl
+        with self.lock:
+            self.entries[entry] = time.monotonic() + ttl
+
+    def excluded(self):
+        now = time.monotonic()
+        with self.lock:
+            for entry in [entry for entry, expiry in self.entries.items() if expiry <= now]:
+                del self.entries[entry]
+            return frozenset(self.entries)
+
+def refresh_graph_tree(excluded):
+    # Rebuild the tree around new failures, at most every failure_refresh_seconds
+    with graph_lock:
+        if excluded == graph.tree_excluded or time.monotonic() - graph.tree_built < failure_refresh_seconds:
+            return
+        graph.compute_tree(this_node, probing_value_msats, excluded, balance_first_hops)
+
+def route_is_excluded(route, excluded):
+    return any(hop['id'] in excluded or f"{hop['channel']}/{hop['direction']}" in excluded for hop in route)
+
+def balanced_route(node_id, excluded):
+    # Leave through the least busy of our channels whose peer can reach
+    # node_id without crossing an excluded channel or node
+    target = graph.index_of(node_id)
+    candidates = {}
+    for short_channel_id, channel in htlc_slots.channels.items():
+        if f"{short_channel_id}/{channel['direction']}" in excluded:
+            continue
+        entry = graph.channels.get((short_channel_id, channel['direction']))
+        if entry is not None and target in graph.peer_trees.get(entry[1][0], ()):
+            candidates[short_channel_id] = entry[1]
+    while candidates:
+        route = graph.route_through(candidates.pop(htlc_slots.choose(candidates, probing_value_msats)), node_id, probing_value_msats)
+        if not route_is_excluded(route, excluded):
+            return route
+    return None
+
+def balanced_planned_route(route, excluded):
+    # The planned route after its first hop, reached through the least busy of
+    # our channels whose peer can get to it
+    planned = [graph.channels[hop['channel'], hop['direction']][1] for hop in route]
+    peer = planned[0][0]
+    start = graph.index_of(this_node)
+    candidates = {}
+    for short_channel_id, channel in htlc_slots.channels.items():
+        entry = graph.channels.get((short_channel_id, channel['direction']))
+        if entry is None or f"{short_channel_id}/{channel['direction']}" in excluded:
+            continue
+        path = [entry[1]]
+        if entry[1][0] != peer:
+            tree = graph.peer_trees.get(entry[1][0], {})
+            if peer not in tree:
+                continue
+            path += graph.path(peer, tree)[1:]
+        path += planned[1:]
+        nodes = [start, *(edge[0] for edge in path)]
+        if len(path) <= max_route_hops and len(set(nodes)) == len(nodes):
+            candidates[short_channel_id] = path
+    while candidates:
+        route = graph.build_route(candidates.pop(htlc_slots.choose(candidates, probing_value_msats)), probing_value_msats)
+        if not route_is_excluded(route, excluded):
+            return route
+    return None
+
+def planned_route(route):
+    # Leave through the least busy of our channels, as find_route does
+    if not (balance_first_hops and htlc_slots is not None and len(htlc_slots.channels) > 1 and graph.peer_trees):
+        return route
+    excluded = failures.excluded() if failures is not None else frozenset()
+    refresh_graph_tree(excluded)
+    return balanced_planned_route(route, excluded) or route
 
-            found_route = True
+def first_hop_exclusions(excluded):
+    # Our channels other than the least busy one, for getroute to avoid
+    usable = [short_channel_id for short_channel_id, channel in htlc_slots.channels.items()
+              if f"{short_channel_id}/{channel['direction']}" not in excluded]
+    if len(usable) < 2:
+        return set()
+    choice = htlc_slots.choose(usable, probing_value_msats)
+    return {f"{short_channel_id}/{channel['direction']}" for short_channel_id, channel in htlc_slots.channels.items() if short_channel_id != choice}
 
+def pin_first_hop(route):
+    # Swap the first hop for the least busy of our channels to the same peer
+    parallel = [short_channel_id for short_channel_id, channel in htlc_slots.channels.items() if channel['peer_id'] == route[0]['id']]
+    if len(parallel) < 2:
+        return route
+    choice = htlc_slots.choose(parallel, to_msat(route[0]['amount_msat']))
+    return [{**route[0], 'channel': choice, 'direction': htlc_slots.channels[choice]['direction']}, *route[1:]]
+
+def find_route(node_id):
+    excluded = failures.excluded() if failures is not None else frozenset()
+    started = time.monotonic()
+    balancing = balance_first_hops and htlc_slots is not None and len(htlc_slots.channels) > 1
+    if graph is not None:
+        refresh_graph_tree(excluded)
+        route = None
+        if balancing and graph.peer_trees:
+            route = balanced_route(node_id, excluded)
+        if route is None:
+            route = graph.route(node_id, probing_value_msats)
+        if route is not None and not route_is_excluded(route, excluded):
+            metrics.observe('route_seconds', time.monotonic() - started, source='local')
+            return route
+    try:
+        pinned = first_hop_exclusions(excluded) if balancing else None
+        if pinned:
             try:
-                print('Trying to find route')
-                probe['route'] = l1.getroute(node['nodeid'],probing_value_msats,1)['route']
-                print('probe route value:', probe['route'])
+                return l1.getroute(node_id, probing_value_msats, 1, exclude=list(excluded | pinned))['route']
+            except RpcError:
+                pass
+        return l1.getroute(node_id, probing_value_msats, 1, exclude=list(excluded) or None)['route']
+    finally:
+        metrics.observe('route_seconds', time.monotonic() - started, source='getroute')
 
-            except RpcError as e:
-                print('Failed to find route')
-                print('Error was:', e)
-                print('Error details:', e.error)
-                print('Method that caused the error:', e.method)
-                print('Payload sent to the method:', e.payload)
-                found_route = False
+class Settlements:
+    # Stands in for waitsendpay when lightningd reports payment results as
+    # sendpay_success/sendpay_failure notifications (plugin.py), so waiting
+    # probes hold no RPC connection. Only expected payment hashes are kept,
+    # lowercased since notifications report them that way.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expected = {}
 
-            if found_route:
-                print('Found route')
-                rand_hash = ''.join(random.choice(string.hexdigits) for _ in range(64))
+    def expect(self, payment_hash):
+        with self.lock:
+            self.expected[payment_hash.lower()] = [threading.Event(), None]
 
-                print('rand_hash:', rand_hash)
+    def forget(self, payment_hash):
+        with self.lock:
+            self.expected.pop(payment_hash.lower(), None)
 
-                print()
+    def resolve(self, payment_hash, failure):
+        with self.lock:
+            entry = self.expected.get(payment_hash.lower())
+        if entry is not None:
+            entry[1] = failure
+            entry[0].set()
 
-                print('Sending payment')
-                send = l1.sendpay(probe['route'],rand_hash)
+    def waitsendpay(self, payment_hash, timeout=None):
+        with self.lock:
+            entry = self.expected[payment_hash.lower()]
+        if not entry[0].wait(timeout):
+            raise RpcError('waitsendpay', {'payment_hash': payment_hash, 'timeout': timeout},
+                           {'code': pay_in_progress_code, 'message': 'Timed out while waiting'})
+        if entry[1] is not None:
+            raise RpcError('waitsendpay', {'payment_hash': payment_hash, 'timeout': timeout}, entry[1])
+        return {'payment_hash': payment_hash, 'status': 'complete'}
 
-                try:
-                    print('Waiting for payment')
-                    probe_r = l1.waitsendpay(rand_hash)
-                except RpcError as e:
-                    probe['finished_at'] = str(datetime.now())
-                    probe['error'] = e.error['data']
-                    probe['failcode'] = e.error['data']['failcode']
+def send_probe(route):
+    # Returns the failure data; an unknown payment hash means the destination was reached
+    # Lowercase, as lightningd reports it in sendpay notifications
+    rand_hash = os.urandom(32).hex()
+    if htlc_slots is not None:
+        htlc_slots.acquire(rand_hash, to_msat(route[0]['amount_msat']), route[0]['channel'])
+    started = time.monotonic()
+    error = {}
+    timed_out = False
+    if settlements is not None:
+        settlements.expect(rand_hash)
+    try:
+        l1.sendpay(route, rand_hash)
+        (l1 if settlements is None else settlements).waitsendpay(rand_hash, probe_timeout_seconds)
+    except RpcError as e:
+        if e.method == 'waitsendpay' and e.error.get('code') == pay_in_progress_code:
+            timed_out = True
+            error = {'failcodename': 'TIMEOUT'}
+            metrics.increment('probe_timeouts_total')
+        else:
+            error = dict(e.error.get('data') or {})
+            if 'failcodename' not in error:
+                # Refused by our own node, e.g. sendpay over a channel it does not have
+                error['failcodename'] = f"{e.method.upper()}_FAILED"
+                events.emit('warning', 'rpc_error', payment_hash=rand_hash, method=e.method, message=e.error.get('message'))
+    if settlements is not None:
+        settlements.forget(rand_hash)
+    if htlc_slots is not None:
+        if timed_out:
+            htlc_slots.mark_stuck(rand_hash)
+        else:
+            htlc_slots.release(rand_hash)
+    settle_seconds = time.monotonic() - started
+    metrics.observe('settle_seconds', settle_seconds, failcode=error.get('failcodename', 'NONE'), hops=len(route))
+    if rate_controller is not None:
+        rate_controller.observe(route, error, settle_seconds)
+    events.emit('debug', 'probe', sampled=True, payment_hash=rand_hash, destination=route[-1]['id'], route=route,
+                failcode=error.get('failcodename'), erring_channel=error.get('erring_channel'), seconds=round(settle_seconds, 6))
+    return error
 
+def route_for_amount(route, amount_msat):
+    # Reuse the hops of a route with a different amount at the destination
+    if graph is not None:
+        path = []
+        for hop in route:
+            channel = graph.channels.get((hop['channel'], hop['direction']))
+            if channel is None:
+                break
+            path.append(channel[1])
+        else:
+            return graph.build_route(path, amount_msat, route[-1]['delay'])
+    # Without fee policies, scale the original fees up so no hop is underpaid
+    final = to_msat(route[-1]['amount_msat'])
+    ratio = max(amount_msat / final, 1)
+    return [dict(hop, amount_msat=amount_msat + math.ceil((to_msat(hop['amount_msat']) - final) * ratio)) for hop in route]
 
-                print('probe:', probe)
+def route_htlc_maximum(route):
+    maximum = liquidity_max_msats
+    if graph is not None:
+        for hop in route:
+            channel = graph.channels.get((hop['channel'], hop['direction']))
+            if channel is not None:
+                maximum = min(maximum, channel[1][7])
+    return maximum
 
-            print('Route found, Sending to database')
-            insert_channel(connection, probe['destination'], probe['error']['failcodename'], probe['error']['erring_node'],probe['error']['erring_channel'],json.dumps(probe['route']),probe['started_at'],100000000)
+def bisect_liquidity(route, error):
+    # Bracket the bottleneck liquidity of the route between a passing and a failing amount
+    if error.get('failcodename') == reached_failcode:
+        lower, upper = probing_value_msats, max(route_htlc_maximum(route), probing_value_msats)
+    elif error.get('failcodename') == liquidity_failcode:
+        lower, upper = 0, probing_value_msats
+    else:
+        return None
+    attempts = 0
+    while upper - lower > liquidity_precision_msats and attempts < liquidity_max_probes:
+        amount = (lower + upper) // 2
+        failcode = send_probe(route_for_amount(route, amount)).get('failcodename')
+        attempts += 1
+        if failcode == reached_failcode:
+            lower = amount
+        elif failcode == liquidity_failcode:
+            upper = amount
         else:
-            print('No route found')
-            insert_channel(connection, probe['destination'], "NO_ROUTE", "NONE", "NONE", "NONE", probe['started_at'], "NONE")
-elif withdraw_now == True:
-    print('Withdrawing to the specified address:', withdrawal_address)
+            break
+    return lower, upper
+
+class Probe:
+    # One destination's probe; __slots__ keeps records small with many in flight
+    __slots__ = ('destination', 'started_at', 'finished_at', 'route', 'error', 'failcode', 'liquidity')
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.started_at = str(datetime.now())
+        self.finished_at = None
+        self.route = None
+        self.error = {}
+        self.failcode = None
+        self.liquidity = None
+
+def plan_channel_routes(node_ids):
+    # Routes covering every channel into node_ids, each ending at its last channel
+    # Our own channels are not worth a planned probe: their balance is known
+    start = graph.index_of(this_node)
+    wanted = {graph.index_of(node_id) for node_id in node_ids}
+    targets = {key for key, (source, edge) in graph.channels.items() if edge[0] in wanted and source != start}
+    paths = graph.plan_coverage(this_node, probing_value_msats, coverage_max_hops, targets)
+    covered = {(edge[1], edge[2]) for path in paths for edge in path} & targets
+    print(f"Planned {len(paths)} routes covering {len(covered)} of {len(targets)} channels")
+    return [graph.build_route(path, probing_value_msats) for path in paths]
+
+def probe_node(node_id, route=None):
+    # Probes along `route` when the sweep was planned, else finds one to node_id
+    probe = Probe(node_id)
+
     try:
-        result = subprocess.run(['lightning-cli', 'withdraw', withdrawal_address], capture_output=True, text=True, check=True)
-        print('Withdrawal successful:', result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error: Unable to withdraw funds - {e}")
-    print('script will wait here for 10000')
-    time.sleep(10000)
-else:
-    print('Not running full probe')
-    print('Waiting for manual intervention...')
-    print('script will wait here for 10000')
-    time.sleep(10000)
+        probe.route = planned_route(route) if route else find_route(node_id)
+    except RpcError as e:
+        events.emit('debug', 'no_route', sampled=True, destination=node_id, error=e.error)
+        probe.finished_at = str(datetime.now())
+        return probe
+
+    if balance_first_hops and htlc_slots is not None and probe.route:
+        probe.route = pin_first_hop(probe.route)
+    probe.error = send_probe(probe.route)
+    probe.failcode = probe.error.get('failcode')
+    if failures is not None:
+        failures.add(probe.error)
+    if estimate_liquidity:
+        probe.liquidity = bisect_liquidity(probe.route, probe.error)
+    probe.finished_at = str(datetime.now())
+    return probe
+
+def record_probe(writer, probe):
+    if probe.route is None:
+        writer.add(((probing_run_id, probe.destination, "NO_ROUTE", "NONE", "NONE", None, probe.started_at, None, None, None, probe.finished_at), None))
+        return
+    error = probe.error
+    lower, upper = probe.liquidity or (None, None)
+    writer.add(((probing_run_id, probe.destination, error.get('failcodename', 'NONE'), error.get('erring_node', 'NONE'), error.get('erring_channel', 'NONE'), json.dumps(probe.route), probe.started_at, probing_value_msats, lower, upper, probe.finished_at), probe.route))
+
+def get_last_results(connection):
+    # Most recent probe time and failcode of every destination in the table
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql.SQL("SELECT DISTINCT ON (dest) dest, time, failcode FROM {} ORDER BY dest, time DESC").format(sql.Identifier(table_name)))
+        return {dest: (str(probed_at), failcode) for dest, probed_at, failcode in cursor.fetchall()}
+    except Exception as e:
+        print(f"Error: Unable to load previous results - {e}")
+        connection.rollback()
+        return {}
+
+def schedule_destinations(node_ids, last_results):
+    # Drop destinations the channel graph cannot reach, then order the rest by
+    # the schedule_order policies, each breaking ties of the one before it:
+    #   capacity      - most inbound capacity (htlc_maximum_msat) first
+    #   staleness     - never probed first, then longest since the last probe
+    #   failures_last - destinations whose last probe failed go last
+    if graph is not None:
+        reachable = {graph.node_id(index) for index in graph.tree}
+    else:
+        reachable = {channel['destination'] for channel in l1.listchannels()['channels']}
+    capacity = collections.Counter()
+    if graph is not None:
+        for edges in graph.edges:
+            for edge in edges:
+                capacity[edge[0]] += edge[7]
+
+    def key(node_id):
+        last = last_results.get(node_id)
+        parts = []
+        for policy in schedule_order:
+            if policy == 'capacity':
+                parts.append(-capacity[graph.index_of(node_id)] if graph is not None else 0)
+            elif policy == 'staleness':
+                parts.append(last[0] if last else '')
+            elif policy == 'failures_last':
+                parts.append(last is not None and last[1] != reached_failcode)
+        return parts
+
+    destinations = [node_id for node_id in node_ids if node_id != this_node and (not skip_unreachable or node_id in reachable)]
+    print(f"Scheduled {len(destinations)} destinations, skipped {len(node_ids) - len(destinations)} unreachable")
+    destinations.sort(key=key)
+    return destinations
+
+def run_probes(writer, node_ids, concurrency, completed, deadline=None, routes=None):
+    # Keep up to `concurrency` probes in flight (fewer while the rate
+    # controller backs off) and record each as it resolves. No new probes
+    # are started after `deadline` (a time.monotonic() value). `routes`, if
+    # given, holds a planned route for each entry of node_ids.
+    counter = 0
+    pending = set()
+    started = time.monotonic()
+
+    def collect(done):
+        nonlocal counter
+        for future in done:
+            counter = counter + 1
+            probe = future.result()
+            if progress_every and counter % progress_every == 0:
+                rate = counter / max(time.monotonic() - started, 1e-9)
+                print(f"Probed {counter} of {len(node_ids)}, {rate:.1f} probes/s")
+                events.emit('info', 'progress', probed=counter, destinations=len(node_ids), probes_per_second=round(rate, 3))
+            metrics.increment('probe_results_total', failcode=probe.error.get('failcodename', 'NO_ROUTE'))
+            record_probe(writer, probe)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for position, node_id in enumerate(node_ids):
+            if deadline is not None and time.monotonic() >= deadline:
+                print('Sweep time budget used up, not starting more probes')
+                break
+            if stop_probing.is_set():
+                print('Probing stopped, not starting more probes')
+                break
+            if node_id == this_node or checkpoint_key(node_id, routes[position] if routes else None) in completed:
+                continue
+            limit, pacing = rate_controller.window() if rate_controller is not None else (concurrency, 0)
+            while len(pending) >= limit:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            if pacing:
+                time.sleep(pacing)
+            pending.add(executor.submit(probe_node, node_id, routes[position] if routes else None))
+        collect(as_completed(pending))
+    return counter
+
+def run_shard(shard_rpc_path, run_id, node_ids, completed, deadline, processes_on_node):
+    # Runs in a spawned worker process, which imports this module afresh and
+    # so gets its own metrics and event log: probes one partition of the
+    # sweep from one lightningd, writing into run_id over its own connection
+    global l1, this_node, graph, failures, htlc_slots, rate_controller, settlements, probing_run_id
+    probing_run_id = run_id
+    l1 = NodeRpc(shard_rpc_path)
+    start_event_log(f"{event_log_file}.{os.getpid()}")
+    # Notifications only reach the plugin's own node, so shards wait on waitsendpay
+    settlements = None
+    this_node = get_this_node()
+    failures = FailureCache(failure_ttl_seconds, failure_permanent_ttl_seconds) if use_failure_cache else None
+    graph = load_channel_graph() if local_routing else None
+    connection = connect_to_database()
+    writer = ResultWriter(connection, write_batch_size, write_flush_seconds)
+    # Processes sharing a node split its HTLC slots and in-flight amount
+    channels = get_our_channels()
+    if channels is not None:
+        channels = {short_channel_id: {**channel, 'slots': channel['slots'] // processes_on_node, 'in_flight_msat': channel['in_flight_msat'] // processes_on_node}
+                    for short_channel_id, channel in channels.items()}
+    slots, in_flight_msat = get_channel_limits(channels)
+    htlc_slots = HtlcSlots(slots, in_flight_msat, channels)
+    window = get_htlc_window(probe_concurrency, htlc_slots.slots)
+    rate_controller = RateController(window) if adaptive_rate else None
+    print(f"Shard on {this_node}: {len(node_ids)} destinations, {window} probes in flight")
+    probed = run_probes(writer, node_ids, window, completed, deadline)
+    report_channel_utilization()
+    writer.close()
+    connection.close()
+    events.close()
+    return probed
+
+def run_sharded(node_ids, completed, deadline):
+    # Deal the scheduled destinations round-robin, so every shard gets a share
+    # of each priority, and run one worker process per shard. Workers are
+    # spawned rather than forked: a fork would copy locks held by the metrics,
+    # event log and result writer threads.
+    workers = len(shard_rpc_paths) * shard_processes_per_node
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(run_shard, shard_rpc_paths[worker % len(shard_rpc_paths)], probing_run_id, node_ids[worker::workers],
+                                   completed, deadline, shard_processes_per_node)
+                   for worker in range(workers)]
+        return sum(future.result() for future in futures)
+
+def get_channel_updates():
+    # last_update and destination node of every channel direction in the gossip
+    updates = {}
+    for channel in l1.listchannels()['channels']:
+        direction = channel.get('direction', 0 if channel['source'] < channel['destination'] else 1)
+        updates[(channel['short_channel_id'], direction)] = (channel.get('last_update', 0), channel['destination'])
+    return updates
+
+def changed_channels(previous, updates):
+    # Channel directions that are new or have a new last_update, mapped to the node they lead to
+    return {key: destination for key, (last_update, destination) in updates.items() if previous.get(key, (None,))[0] != last_update}
+
+def select_destinations(node_ids, last_results, changed):
+    # Destinations worth re-probing: never probed, probed before the freshness
+    # window, reached through a changed channel, or routed across one by the
+    # previous sweep's shortest-path tree
+    cutoff = str(datetime.now() - timedelta(seconds=freshness_seconds))
+    selected = set(changed.values())
+    if graph is not None and changed:
+        crosses = {}
+
+        def crosses_changed(index):
+            if index not in crosses:
+                parent, edge = graph.tree[index]
+                crosses[index] = (edge[1], edge[2]) in changed or (parent in graph.tree and crosses_changed(parent))
+            return crosses[index]
+        selected.update(graph.node_id(index) for index in graph.tree if crosses_changed(index))
+    destinations = []
+    for node_id in node_ids:
+        last = last_results.get(node_id)
+        if last is None or last[0] < cutoff or node_id in selected:
+            destinations.append(node_id)
+    return destinations
+
+def run_daemon(connection, first_run_id=None):
+    # Sweep every daemon_interval_seconds until stop_probing is set, each
+    # sweep recorded as its own run. Only the first sweep can resume a run,
+    # and it uses first_run_id if the caller already claimed one.
+    global probing_run_id
+    base_run_id = probing_run_id
+    previous = None
+    resume = resume_run
+    while not stop_probing.is_set():
+        started = time.monotonic()
+        probing_run_id = first_run_id or claim_run_id(connection, base_run_id, resume)
+        first_run_id = None
+        resume = False
+        updates = get_channel_updates()
+        changed = changed_channels(previous, updates) if previous is not None else {}
+        node_ids = [node['nodeid'] for node in l1.listnodes()['nodes']]
+        destinations = select_destinations(node_ids, get_last_results(connection), changed)
+        print(f"Sweep {probing_run_id}: {len(changed)} channels updated, re-probing {len(destinations)} of {len(node_ids)} nodes")
+        # Flush this sweep's rows if the process is stopped mid-sweep
+        writer = ResultWriter(connection, write_batch_size, write_flush_seconds)
+        atexit.register(writer.close)
+        run_sweep(connection, writer, destinations)
+        atexit.unregister(writer.close)
+        previous = updates
+        stop_probing.wait(max(daemon_interval_seconds - (time.monotonic() - started), 0))
+
+def report_channel_utilization():
+    for channel in htlc_slots.utilization():
+        print(f"Channel {channel['short_channel_id']} to {channel['peer_id']}: {channel['probes']} probes, "
+              f"at most {channel['peak_in_flight']} of {channel['slots']} HTLC slots in use")
+        events.emit('info', 'channel_utilization', **channel)
+
+def run_sweep(connection, writer, node_ids):
+    # Probe node_ids once under probing_run_id, then close the writer
+    global graph, failures, htlc_slots, rate_controller, planned_checkpoints
+    failures = FailureCache(failure_ttl_seconds, failure_permanent_ttl_seconds) if use_failure_cache else None
+    graph = None
+    if local_routing:
+        print('Loading channel graph...')
+        graph = load_channel_graph()
+    channels = get_our_channels()
+    slots, in_flight_msat = get_channel_limits(channels)
+    htlc_slots = HtlcSlots(slots, in_flight_msat, channels)
+    window = get_htlc_window(probe_concurrency, slots)
+    rate_controller = RateController(window) if adaptive_rate else None
+    print('Probes in flight:', window)
+    print('Going through nodes...', len(node_ids))
+    completed = set()
+    if resume_run:
+        completed = get_completed_destinations(connection)
+        print(f"Resuming run {probing_run_id}, skipping {len(completed)} destinations or planned routes already probed")
+    destinations = schedule_destinations(node_ids, get_last_results(connection) if schedule_order else {})
+    routes = None
+    if probe_plan == 'channels':
+        if graph is None:
+            print('Channel coverage needs local_routing, probing destinations instead')
+        elif shard_rpc_paths:
+            # Planned routes leave through this node's channels, which the shards do not have
+            print('Channel coverage is not supported with shard_rpc_paths, probing destinations instead')
+        else:
+            routes = plan_channel_routes(destinations)
+            destinations = [route[-1]['id'] for route in routes]
+    planned_checkpoints = routes is not None
+    deadline = time.monotonic() + sweep_budget_seconds if sweep_budget_seconds else None
+    events.emit('info', 'sweep_started', destinations=len(destinations), probes_in_flight=window, plan=probe_plan if routes else 'destinations')
+    sweep_started = time.monotonic()
+    start_run(connection)
+    if shard_rpc_paths:
+        print(f"Sharding the sweep across {len(shard_rpc_paths)} nodes, {shard_processes_per_node} processes each")
+        probed = run_sharded(destinations, completed, deadline)
+    else:
+        probed = run_probes(writer, destinations, window, completed, deadline, routes)
+    print('Probed nodes:', probed)
+    if not shard_rpc_paths:
+        report_channel_utilization()
+    events.emit('info', 'sweep_finished', probed=probed, seconds=round(time.monotonic() - sweep_started, 3))
+    writer.close()
+    if channel_history:
+        fold_channel_history(connection)
+    finish_run(connection)
+    return probed
+
+# Set up by the main block below; bench.py and plugin.py assign these directly
+l1 = None
+this_node = None
+graph = None
+graph_lock = threading.Lock()
+failures = None
+htlc_slots = None
+rate_controller = None
+settlements = None
+planned_checkpoints = False
+stop_probing = threading.Event()
+
+if __name__ == '__main__':
+    # Add a check to see if /electrum/wallet exists, if it doesn't then make it
+    if not os.path.exists('/electrum/wallet/'):
+        os.makedirs('/electrum/wallet/')
+
+    print('Loading electrum wallet...')
+    # Recover Electrum wallet from seed
+    subprocess.run(['electrum', 'restore', electrum_seed], check=True)
+    print('Wallet loaded.')
+
+    print('Loading electrum wallet...')
+    # Load the wallet
+    subprocess.run(['electrum', 'load_wallet',], check=True)
+    print('Electrum wallet loaded..')
+
+    print('Getting info of the wallet...')
+    subprocess.run(['electrum', 'getinfo'], check=True)
+
+    print('Waiting for the wallet balance...')
+    # recovered balance looks like this: { "confirmed": "1.06396422" }
+    recovered_balance = wait_for(electrum_balance, 'the Electrum wallet balance')
+    print('Recovered balance:', recovered_balance)
+
+
+    user_input = input("Continue? (y/n): ")
+    if user_input == 'n':
+        print('Exiting script')
+        exit()
+    elif user_input != 'y':
+        print('Invalid input, exiting script')
+        exit()
+    else:
+        print('Continuing script')
+
+    print('Waiting for the lightningd RPC socket at:', rpc_path)
+    wait_for(lambda: os.path.exists(rpc_path), 'the lightningd RPC socket')
+    l1 = NodeRpc(rpc_path, TraceRecorder(rpc_trace_file) if rpc_trace_file else None)
+
+    print('Checking if lightningd is synchronized...')
+    latest_blockheight = wait_for(get_latest_blockheight, 'the latest block height')
+    wait_for(lambda: reached_blockheight(latest_blockheight - 1), 'lightningd to synchronize')
+    print('lightningd is synchronized')
+
+    this_node = get_this_node()
+    print('This node:', this_node)
+
+    print('Connecting to database')
+    connection = connect_to_database()
+    
+    if connection:
+        print('Connected to database')
+        print('Creating table')
+        create_table(connection)
+
+    # Flush buffered probe rows on normal exit, errors and `docker stop`
+    writer = ResultWriter(connection, write_batch_size, write_flush_seconds)
+    atexit.register(writer.close)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    start_metrics_export()
+    start_event_log()
+
+    print('l1 is equal to:', l1)
+    print('Trying to get list of nodes')
+    # Only the ids are kept; addresses, features and aliases are dropped
+    node_ids = [node['nodeid'] for node in l1.listnodes()['nodes']]
+
+    print('Num Nodes: ' + str(len(node_ids)))
+
+    funds = l1.listfunds()
+    # connect to a initial node
+    print('Funds available:', funds)
+
+    # Generate a new payment address
+    paymentAddress = l1.newaddr()
+    print('Payment Address:', paymentAddress)
+
+    # Send payment to the new address
+    amount_btc = "0.001"  # specify the amount to send in BTC
+    subprocess.run(['electrum', 'payto', paymentAddress, amount_btc, '--wallet', '/electrum/wallet'], check=True)
+
+    print('Connecting to intial node')
+    # connect to a intial node
+    connect = l1.connect(initial_channel_node_id, initial_channel_host, initial_channel_port)
+    print('Connected to initial node')
+
+    peers = l1.listpeers()
+    print('List Peers:', peers)
+
+    print('Starting main loop')
+    if run_full_probe:
+        print('Check if the node is funded...')
+        usable_channels = get_our_channels()
+        if not usable_channels:
+            print('Node has no usable channels. Exiting...')
+            sys.exit(1)
+        else:
+            print(f"Node is funded, {len(usable_channels)} usable channels. Continuing...")
+            if daemon_mode:
+                run_daemon(connection)
+            else:
+                probing_run_id = claim_run_id(connection, probing_run_id, resume_run)
+                run_sweep(connection, writer, node_ids)
+    elif withdraw_now:
+        print('Withdrawing to the specified address:', withdrawal_address)
+        try:
+            result = l1.withdraw(withdrawal_address, 'all')
+            print('Withdrawal successful:', result)
+        except RpcError as e:
+            print(f"Error: Unable to withdraw funds - {e}")
+        print('script will wait here for 10000')
+        time.sleep(10000)
+    else:
+        print('Not running full probe')
+        print('Waiting for manual intervention...')
+        print('script will wait here for 10000')
+        time.sleep(10000)
 
-print('Closing connection')
-connection.close()
+    print('Closing connection')
+    writer.close()
+    connection.close()
@@ -0,0 +1,298 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+from psycopg2 import sql
+
+# probe.py reads config.ini from the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+import probe
+
+# Node ids and short_channel_ids stored for failures that have none
+missing_values = (b'\\N', b'NONE')
+
+
+def copy_columns(connection, query, params, width):
+    # Stream the rows out with COPY instead of building a tuple per row, and
+    # split them into one bytes array per column. COPY separates fields with
+    # tabs and rows with newlines, escaping both inside values; NULLs come out
+    # as \N.
+    cursor = connection.cursor()
+    statement = cursor.mogrify(query.as_string(connection), params).decode()
+    buffer = io.BytesIO()
+    cursor.copy_expert(f"COPY ({statement}) TO STDOUT", buffer)
+    fields = buffer.getvalue().replace(b'\n', b'\t').split(b'\t')[:-1]
+    rows = np.array(fields, dtype=bytes).reshape(-1, width)
+    return [rows[:, column] for column in range(width)]
+
+
+def factorize(values):
+    # Distinct values and each row's index into them. np.unique on strings
+    # compares them byte by byte, so hash every fixed-width value into one
+    # uint64 (FNV-1a over 8-byte words) and find the distinct hashes instead,
+    # falling back to np.unique if two distinct values share a hash.
+    count, width = len(values), values.dtype.itemsize
+    words = np.zeros((count, -(-width // 8) * 8), dtype=np.uint8)
+    words[:, :width] = np.ascontiguousarray(values).view(np.uint8).reshape(count, width)
+    hashes = np.full(count, 0xcbf29ce484222325, dtype=np.uint64)
+    for column in words.view(np.uint64).T:
+        hashes = (hashes ^ column) * np.uint64(0x100000001b3)
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    dictionary = values[first]
+    if not (dictionary[inverse] == values).all():
+        return np.unique(values, return_inverse=True)
+    return dictionary, inverse
+
+
+def encode(*columns, missing=(b'\\N',)):
+    # One dictionary shared by all the columns, and int32 indexes into it
+    # for each column, -1 where the value is missing
+    present = [~np.isin(column, missing) for column in columns]
+    dictionary, inverse = factorize(np.concatenate([column[mask] for column, mask in zip(columns, present)]))
+    codes = []
+    offset = 0
+    for column, mask in zip(columns, present):
+        column_codes = np.full(len(column), -1, dtype=np.int32)
+        column_codes[mask] = inverse[offset:offset + mask.sum()]
+        offset += mask.sum()
+        codes.append(column_codes)
+    return dictionary, codes
+
+
+def integers(values):
+    return np.where(values == b'\\N', b'-1', values).astype(np.int64)
+
+
+def code_of(dictionary, value):
+    # Index of value in a dictionary, or -2, which matches no code
+    index = np.flatnonzero(dictionary == value)
+    return index[0] if len(index) else -2
+
+
+def run_filter(run_ids):
+    # Rows written before runs had ids belong to no run
+    if run_ids is None:
+        return sql.SQL('run_id IS NOT NULL'), ()
+    return sql.SQL('run_id = ANY(%s)'), (list(run_ids),)
+
+
+def load_columns(connection, run_ids):
+    # The runs' probes and hops as fixed-width arrays. Run ids, node ids,
+    # short_channel_ids and failcodes are indexes into one dictionary each,
+    # times are microseconds since the epoch, and -1 means no value. Tables
+    # created before route, time and amount were typed hold them as VARCHAR,
+    # with 'NONE' for a missing value, until probe.py's create_table converts
+    # them, so those are cast only when they parse.
+    condition, params = run_filter(run_ids)
+    query = sql.SQL("""
+        SELECT id, run_id, dest, failcode, NULLIF(erring_node, ''), NULLIF(erring_channel, ''),
+               CASE WHEN left(route::text, 1) = '[' THEN jsonb_array_length(route::text::jsonb) ELSE 0 END,
+               CASE WHEN amount::text ~ '^-?[0-9]+$' THEN amount::text::bigint END,
+               liquidity_lower_msat, liquidity_upper_msat,
+               CASE WHEN time::text ~ '^[0-9]{{4}}-' THEN (EXTRACT(EPOCH FROM time::text::timestamp) * 1000000)::bigint END,
+               (EXTRACT(EPOCH FROM finished_at::timestamp) * 1000000)::bigint
+        FROM {} WHERE {} ORDER BY id
+    """).format(sql.Identifier(probe.table_name), condition)
+    (probe_ids, runs, dests, failcodes, erring_nodes, erring_channels, hop_counts,
+     amounts, lower, upper, started, finished) = copy_columns(connection, query, params, 12)
+    query = sql.SQL("""
+        SELECT probe_id, position, short_channel_id, node, amount_msat, result
+        FROM {} WHERE {} ORDER BY probe_id, position
+    """).format(sql.Identifier(probe.table_name + '_hops'), condition)
+    hop_probe_ids, positions, hop_channels, hop_nodes, hop_amounts, hop_results = copy_columns(connection, query, params, 6)
+
+    run_names, (run_codes,) = encode(runs)
+    nodes, (dest_codes, erring_node_codes, hop_node_codes) = encode(dests, erring_nodes, hop_nodes, missing=missing_values)
+    channels, (erring_channel_codes, hop_channel_codes) = encode(erring_channels, hop_channels, missing=missing_values)
+    failcode_names, (failcode_codes, hop_result_codes) = encode(failcodes, hop_results)
+    probe_ids = integers(probe_ids)
+    return {
+        'runs': run_names,
+        'nodes': nodes,
+        'channels': channels,
+        'failcodes': failcode_names,
+        'probe_id': probe_ids,
+        'probe_run': run_codes,
+        'probe_dest': dest_codes,
+        'probe_failcode': failcode_codes,
+        'probe_erring_node': erring_node_codes,
+        'probe_erring_channel': erring_channel_codes,
+        'probe_hops': hop_counts.astype(np.int16),
+        'probe_amount_msat': integers(amounts),
+        'probe_liquidity_lower_msat': integers(lower),
+        'probe_liquidity_upper_msat': integers(upper),
+        'probe_started_us': integers(started),
+        'probe_finished_us': integers(finished),
+        # Each hop's row in the probe_ columns
+        'hop_probe': np.searchsorted(probe_ids, integers(hop_probe_ids)).astype(np.int32),
+        'hop_position': positions.astype(np.int16),
+        'hop_channel': hop_channel_codes,
+        'hop_node': hop_node_codes,
+        'hop_amount_msat': integers(hop_amounts),
+        'hop_result': hop_result_codes,
+    }
+
+
+def load_channel_history(connection, channel):
+    # The runs where a channel direction's last result or liquidity bounds
+    # changed. `channel` is a short_channel_id for both directions, or
+    # short_channel_id/direction for one.
+    short_channel_id, _, direction = channel.partition('/')
+    cursor = connection.cursor()
+    cursor.execute(sql.SQL("""
+        SELECT direction, run_id, observed_at, last_result, liquidity_lower_msat, liquidity_upper_msat, attempts, failures
+        FROM {} WHERE short_channel_id = %s AND (%s IS NULL OR direction = %s) ORDER BY direction, observed_at
+    """).format(sql.Identifier(probe.table_name + '_channel_history')),
+        (short_channel_id, int(direction) if direction else None, int(direction) if direction else None))
+    return [{'direction': direction, 'run_id': run_id, 'observed_at': str(observed_at), 'last_result': last_result, 'liquidity_lower_msat': lower,
+             'liquidity_upper_msat': upper, 'attempts': attempts, 'failures': failures}
+            for direction, run_id, observed_at, last_result, lower, upper, attempts, failures in cursor.fetchall()]
+
+
+def export_columns(columns, directory):
+    # One .npy file per column so each can be memory-mapped on its own, and
+    # a manifest listing them
+    os.makedirs(directory, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(directory, name + '.npy'), values)
+    with open(os.path.join(directory, 'manifest.json'), 'w') as manifest:
+        json.dump({
+            'table': probe.table_name,
+            'runs': [run.decode() for run in columns['runs']],
+            'probes': len(columns['probe_id']),
+            'hops': len(columns['hop_probe']),
+            'columns': list(columns),
+            'exported_at': str(datetime.now()),
+        }, manifest, indent=1)
+
+
+def load_export(directory):
+    # Nothing is read until a column is used
+    with open(os.path.join(directory, 'manifest.json')) as manifest:
+        names = json.load(manifest)['columns']
+    return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in names}
+
+
+def summarize(columns, top, min_attempts):
+    failcodes = columns['failcodes']
+    probe_failcode = np.asarray(columns['probe_failcode'])
+    reached = probe_failcode == code_of(failcodes, probe.reached_failcode.encode())
+
+    runs = columns['runs']
+    run_probes = np.bincount(columns['probe_run'], minlength=len(runs))
+    run_reached = np.bincount(columns['probe_run'], weights=reached, minlength=len(runs))
+
+    code_counts = np.bincount(probe_failcode[probe_failcode >= 0], minlength=len(failcodes))
+    order = [index for index in np.argsort(-code_counts, kind='stable') if code_counts[index]]
+
+    hop_counts = np.asarray(columns['probe_hops'])
+    by_hops = np.bincount(hop_counts)
+    reached_by_hops = np.bincount(hop_counts, weights=reached, minlength=len(by_hops))
+
+    # A destination counts as reachable if any of its probes got there
+    dest_probes = np.bincount(columns['probe_dest'], minlength=len(columns['nodes']))
+    dest_reached = np.bincount(columns['probe_dest'], weights=reached, minlength=len(columns['nodes'])) > 0
+
+    hop_results = np.asarray(columns['hop_result'])
+    attributed = hop_results >= 0
+    channel_index = np.asarray(columns['hop_channel'])[attributed]
+    passed = hop_results[attributed] == code_of(failcodes, b'PASSED')
+    names = columns['channels']
+    attempts = np.bincount(channel_index, minlength=len(names))
+    failures = attempts - np.bincount(channel_index, weights=passed, minlength=len(names)).astype(np.int64)
+    failure_rate = failures / np.maximum(attempts, 1)
+    eligible = np.flatnonzero(attempts >= min_attempts)
+    worst = eligible[np.lexsort((-attempts[eligible], -failure_rate[eligible]))][:top]
+
+    return {
+        'probes': int(len(probe_failcode)),
+        'reached_rate': float(reached.mean()) if len(reached) else 0.0,
+        'destinations': int(np.count_nonzero(dest_probes)),
+        'reachable_destinations': int(dest_reached.sum()),
+        'runs': [{'run_id': run.decode(), 'probes': int(count), 'reached_rate': float(hits / count)}
+                 for run, count, hits in zip(runs, run_probes, run_reached)],
+        'failcodes': {failcodes[index].decode(): int(code_counts[index]) for index in order},
+        'hops': [{'hops': hops, 'probes': int(by_hops[hops]), 'reached_rate': float(reached_by_hops[hops] / by_hops[hops])}
+                 for hops in np.flatnonzero(by_hops).tolist()],
+        'channels': int(np.count_nonzero(attempts)),
+        'channel_failure_rate': float(failures.sum() / attempts.sum()) if attempts.sum() else 0.0,
+        'worst_channels': [{'short_channel_id': names[index].decode(), 'attempts': int(attempts[index]), 'failure_rate': float(failure_rate[index])}
+                           for index in worst],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize stored probe results: reachability, failcodes and per-channel failure rates.')
+    parser.add_argument('--run', action='append', dest='runs', help='run id to include, may be repeated (default: probing_run_id from config.ini)')
+    parser.add_argument('--all-runs', action='store_true', help='include every run in the table')
+    parser.add_argument('--top', type=int, default=20, help='number of worst channels to list')
+    parser.add_argument('--min-attempts', type=int, default=3, help='probes a channel needs before it is ranked')
+    parser.add_argument('--export', metavar='DIR', help='write the runs to DIR as memory-mappable .npy columns instead of reporting')
+    parser.add_argument('--from-export', metavar='DIR', help='report on a directory written by --export instead of the database')
+    parser.add_argument('--history', metavar='SCID[/DIRECTION]', help='show how a channel\'s state changed across runs instead of reporting')
+    parser.add_argument('--json', action='store_true', help='print the report as one JSON line')
+    args = parser.parse_args()
+
+    if args.history:
+        connection = probe.connect_to_database()
+        if connection is None:
+            return 1
+        history = load_channel_history(connection, args.history)
+        connection.close()
+        if args.json:
+            print(json.dumps(history))
+            return 0
+        for row in history:
+            bounds = f"{row['liquidity_lower_msat'] or 0}-{row['liquidity_upper_msat'] or 'unknown'} msat"
+            print(f"{row['observed_at']} direction {row['direction']} run {row['run_id']}: {row['last_result']}, liquidity {bounds}, {row['failures']} of {row['attempts']} failed so far")
+        return 0
+
+    load_started = time.monotonic()
+    if args.from_export:
+        columns = load_export(args.from_export)
+    else:
+        connection = probe.connect_to_database()
+        if connection is None:
+            return 1
+        columns = load_columns(connection, None if args.all_runs else (args.runs or [probe.probing_run_id]))
+        connection.close()
+    load_seconds = time.monotonic() - load_started
+
+    if args.export:
+        export_columns(columns, args.export)
+        print(f"Exported {len(columns['probe_id'])} probes and {len(columns['hop_probe'])} hops to {args.export}")
+        return 0
+
+    analysis_started = time.monotonic()
+    report = summarize(columns, args.top, args.min_attempts)
+    report['load_seconds'] = round(load_seconds, 3)
+    report['analysis_seconds'] = round(time.monotonic() - analysis_started, 3)
+
+    if args.json:
+        print(json.dumps(report))
+        return 0
+    print(f"Probes: {report['probes']}, reached {report['reached_rate']:.1%}")
+    print(f"Destinations: {report['destinations']}, reachable {report['reachable_destinations']}")
+    for run in report['runs']:
+        print(f"  run {run['run_id']}: {run['probes']} probes, reached {run['reached_rate']:.1%}")
+    print('Failcodes:')
+    for failcode, count in report['failcodes'].items():
+        print(f"  {failcode}: {count} ({count / report['probes']:.1%})")
+    print('Reached by route length:')
+    for row in report['hops']:
+        print(f"  {row['hops']} hops: {row['probes']} probes, reached {row['reached_rate']:.1%}")
+    print(f"Channels with results: {report['channels']}, failure rate {report['channel_failure_rate']:.1%}")
+    print(f"Worst channels (at least {args.min_attempts} attempts):")
+    for row in report['worst_channels']:
+        print(f"  {row['short_channel_id']}: {row['failure_rate']:.1%} of {row['attempts']}")
+    print(f"Loaded in {report['load_seconds']}s, analysed in {report['analysis_seconds']}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,415 @@
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import resource
+import sqlite3
+import sys
+import threading
+import time
+
+from pyln.client import RpcError
+
+# probe.py reads config.ini from the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+import probe
+
+# Failure codes returned by the fake node, as lightningd reports them
+TEMPORARY_CHANNEL_FAILURE = (0x1007, 'WIRE_TEMPORARY_CHANNEL_FAILURE')
+UNKNOWN_NEXT_PEER = (0x400a, 'WIRE_UNKNOWN_NEXT_PEER')
+INCORRECT_OR_UNKNOWN_PAYMENT_DETAILS = (0x400f, 'WIRE_INCORRECT_OR_UNKNOWN_PAYMENT_DETAILS')
+
+
+def random_node_id(rng):
+    return '02' + ''.join(rng.choice('0123456789abcdef') for _ in range(64))
+
+
+class FakeLightningRpc:
+    # Stands in for LightningRpc over a synthetic network. Every channel gets a
+    # random liquidity split; probes fail where the amount exceeds it, or at
+    # random with failure_rate, and otherwise reach the destination. With more
+    # than congestion_htlcs in flight on one of our channels, settling through
+    # it slows down and it starts failing with TEMPORARY_CHANNEL_FAILURE.
+    def __init__(self, num_nodes, channels_per_node, our_channels, latency_ms, latency_sigma, failure_rate, seed, congestion_htlcs=0):
+        self.rng = random.Random(seed)
+        self.congestion_htlcs = congestion_htlcs
+        self.in_flight = collections.Counter()
+        # Set to Settlements.resolve to report results as notifications
+        self.notify = None
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.node_id = random_node_id(self.rng)
+        self.nodes = [random_node_id(self.rng) for _ in range(num_nodes)]
+        self.channels = []
+        self.liquidity = {}
+        self.adjacency = {}
+        self.pending = {}
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+        # Preferential attachment, so a few hubs carry most channels
+        endpoints = [self.nodes[0]]
+        block = 500000
+        for position, node_id in enumerate(self.nodes[1:], start=1):
+            for peer in {self.rng.choice(endpoints) for _ in range(min(channels_per_node, position))}:
+                block += 1
+                self.add_channel(node_id, peer, f"{block}x{self.rng.randint(1, 3000)}x0")
+                endpoints.append(peer)
+            endpoints.append(node_id)
+        self.our_channels = []
+        for peer in self.rng.sample(endpoints, min(our_channels, len(endpoints))):
+            block += 1
+            short_channel_id = f"{block}x1x0"
+            self.add_channel(self.node_id, peer, short_channel_id)
+            self.our_channels.append((peer, short_channel_id))
+
+    def add_channel(self, node_a, node_b, short_channel_id):
+        capacity = self.rng.choice([1000000, 2000000, 5000000, 10000000, 16777215]) * 1000
+        split = int(capacity * self.rng.random())
+        for source, destination, balance in [(node_a, node_b, split), (node_b, node_a, capacity - split)]:
+            direction = 0 if source < destination else 1
+            self.channels.append({
+                'source': source,
+                'destination': destination,
+                'short_channel_id': short_channel_id,
+                'direction': direction,
+                'public': True,
+                'amount_msat': capacity,
+                'active': True,
+                'last_update': int(time.time()),
+                'base_fee_millisatoshi': self.rng.choice([0, 1000]),
+                'fee_per_millionth': self.rng.choice([1, 10, 100, 500]),
+                'delay': self.rng.choice([40, 80, 144]),
+                'htlc_minimum_msat': 1000,
+                'htlc_maximum_msat': capacity,
+            })
+            self.liquidity[short_channel_id, direction] = balance
+            self.adjacency.setdefault(source, []).append((destination, short_channel_id, direction))
+
+    def getinfo(self):
+        return {'id': self.node_id, 'blockheight': 800000}
+
+    def cached_getinfo(self):
+        return self.getinfo()
+
+    def listnodes(self):
+        return {'nodes': [{'nodeid': node_id} for node_id in self.nodes]}
+
+    def listchannels(self):
+        return {'channels': self.channels}
+
+    def listpeerchannels(self):
+        return {'channels': [{
+            'peer_id': peer,
+            'short_channel_id': short_channel_id,
+            'direction': 0 if self.node_id < peer else 1,
+            'state': 'CHANNELD_NORMAL',
+            'spendable_msat': self.liquidity[short_channel_id, 0 if self.node_id < peer else 1],
+            'max_accepted_htlcs': 483,
+        } for peer, short_channel_id in self.our_channels]}
+
+    def getroute(self, node_id, amount_msat, riskfactor, cltv=9, exclude=None, **kwargs):
+        # Breadth-first search; fees are not modelled by the fake node
+        excluded = set(exclude or [])
+        previous = {self.node_id: None}
+        frontier = [self.node_id]
+        while frontier and node_id not in previous:
+            next_frontier = []
+            for current in frontier:
+                for destination, short_channel_id, direction in self.adjacency.get(current, []):
+                    if destination in previous or destination in excluded or f"{short_channel_id}/{direction}" in excluded:
+                        continue
+                    previous[destination] = (current, short_channel_id, direction)
+                    next_frontier.append(destination)
+            frontier = next_frontier
+        if node_id not in previous:
+            raise RpcError('getroute', {'id': node_id}, {'code': 205, 'message': 'Could not find a route'})
+        route = []
+        current = node_id
+        while previous[current] is not None:
+            source, short_channel_id, direction = previous[current]
+            route.append({'id': current, 'channel': short_channel_id, 'direction': direction,
+                          'amount_msat': amount_msat, 'delay': cltv, 'style': 'tlv'})
+            current = source
+        route.reverse()
+        return {'route': route}
+
+    def update_channels(self, count):
+        # New channel_updates for `count` random channel directions
+        for channel in self.rng.sample(self.channels, min(count, len(self.channels))):
+            channel['last_update'] += 1
+
+    def sendpay(self, route, payment_hash, **kwargs):
+        # lightningd takes either case but reports hashes in lowercase
+        payment_hash = payment_hash.lower()
+        with self.lock:
+            self.in_flight[route[0]['channel']] += 1
+            overload = self.in_flight[route[0]['channel']] / self.congestion_htlcs if self.congestion_htlcs else 0
+        latency = self.rng.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma) * max(overload, 1)
+        with self.lock:
+            self.pending[payment_hash] = (route, overload, latency)
+        if self.notify is not None:
+            # Settle in the background and report it like a sendpay_failure notification
+            threading.Timer(latency, self.settle, (payment_hash,)).start()
+        return {'payment_hash': payment_hash, 'status': 'pending'}
+
+    def settle(self, payment_hash):
+        with self.lock:
+            route, overload, _ = self.pending.pop(payment_hash)
+            self.in_flight[route[0]['channel']] -= 1
+        self.notify(payment_hash, self.outcome(payment_hash, route, overload))
+
+    def waitsendpay(self, payment_hash, timeout=None, **kwargs):
+        payment_hash = payment_hash.lower()
+        with self.lock:
+            route, overload, latency = self.pending.pop(payment_hash)
+        try:
+            if timeout is not None and latency > timeout:
+                # The HTLC stays out past the timeout and resolves afterwards
+                time.sleep(timeout)
+                with self.lock:
+                    self.statuses[payment_hash] = 'failed'
+                raise RpcError('waitsendpay', {'payment_hash': payment_hash, 'timeout': timeout},
+                               {'code': 200, 'message': 'Timed out while waiting'})
+            time.sleep(latency)
+        finally:
+            with self.lock:
+                self.in_flight[route[0]['channel']] -= 1
+        raise RpcError('waitsendpay', {'payment_hash': payment_hash}, self.outcome(payment_hash, route, overload))
+
+    def listsendpays(self, payment_hash=None, **kwargs):
+        with self.lock:
+            status = self.statuses.get(payment_hash.lower())
+        return {'payments': [{'payment_hash': payment_hash, 'status': status}] if status else []}
+
+    def outcome(self, payment_hash, route, overload):
+        source = self.node_id
+        for position, hop in enumerate(route):
+            failure = None
+            if position == 0 and overload > 1 and self.rng.random() > 1 / overload:
+                failure = TEMPORARY_CHANNEL_FAILURE
+            elif self.liquidity.get((hop['channel'], hop['direction']), 0) < int(hop['amount_msat']):
+                failure = TEMPORARY_CHANNEL_FAILURE
+            elif position > 0 and self.rng.random() < self.failure_rate:
+                failure = UNKNOWN_NEXT_PEER
+            if failure is not None:
+                return self.failure(payment_hash, 204, failure, position, source, hop)
+            source = hop['id']
+        return self.failure(payment_hash, 203, INCORRECT_OR_UNKNOWN_PAYMENT_DETAILS, len(route), route[-1]['id'], route[-1])
+
+    def failure(self, payment_hash, code, failure, position, erring_node, hop):
+        failcode, failcodename = failure
+        return {
+            'code': code,
+            'message': failcodename,
+            'data': {
+                'payment_hash': payment_hash,
+                'erring_index': position,
+                'failcode': failcode,
+                'failcodename': failcodename,
+                'erring_node': erring_node,
+                'erring_channel': hop['channel'],
+                'erring_direction': hop['direction'],
+            },
+        }
+
+def sqlite_insert_channels(connection, rows):
+    # Same batching path as Postgres, written to SQLite
+    write_started = time.monotonic()
+    connection.executemany(f"INSERT INTO results ({', '.join(probe.result_columns)}) VALUES ({', '.join('?' * len(probe.result_columns))})",
+                           [tuple(str(value) if value is not None else None for value in values) for values, _ in rows])
+    connection.executemany("INSERT INTO hops VALUES (?, ?, ?, ?, ?)",
+                           [(values[1], position, hop['channel'], hop['id'], result) for values, route in rows
+                            for position, (hop, result) in enumerate(zip(route or [], probe.hop_results(route or [], values[2], values[4])))])
+    connection.commit()
+    probe.metrics.observe('db_write_seconds', time.monotonic() - write_started)
+    return True
+
+
+def connect_sqlite(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, {', '.join(probe.result_columns)})")
+    connection.execute("CREATE TABLE IF NOT EXISTS hops (dest TEXT, position INTEGER, short_channel_id TEXT, node TEXT, result TEXT)")
+    return connection
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(args):
+    setup_started = time.monotonic()
+    if args.replay:
+        rpc = probe.ReplayRpc(args.replay, args.replay_speed)
+    else:
+        rpc = FakeLightningRpc(args.nodes, args.channels_per_node, args.our_channels, args.latency_ms,
+                               args.latency_sigma, args.failure_rate, args.seed, args.congestion_htlcs)
+    setup_seconds = time.monotonic() - setup_started
+
+    probe.l1 = rpc
+    probe.this_node = rpc.cached_getinfo()['id']
+    probe.probing_run_id = f"bench-{int(time.time())}"
+    probe.probing_value_msats = args.amount_msats
+    probe.estimate_liquidity = args.estimate_liquidity
+    probe.probe_timeout_seconds = args.probe_timeout
+    probe.balance_first_hops = args.balance_first_hops
+    probe.progress_every = args.progress_every
+    probe.event_log_file = args.event_log or ''
+    probe.event_log_level = args.event_level
+    probe.event_sample_rate = args.event_sample
+    probe.start_event_log()
+    if args.notifications and not args.replay:
+        probe.settlements = probe.Settlements()
+        rpc.notify = probe.settlements.resolve
+    probe.failures = probe.FailureCache(probe.failure_ttl_seconds, probe.failure_permanent_ttl_seconds) if args.failure_cache else None
+
+    graph_started = time.monotonic()
+    probe.graph = probe.load_channel_graph() if args.local_routing else None
+    graph_seconds = time.monotonic() - graph_started
+
+    if args.dsn:
+        import psycopg2
+        connection = psycopg2.connect(args.dsn)
+        probe.table_name = args.table
+        probe.create_table(connection)
+    else:
+        connection = connect_sqlite(args.sqlite)
+        probe.insert_channels = sqlite_insert_channels
+    writer = probe.ResultWriter(connection, args.batch_size, args.flush_seconds)
+
+    # Time each destination from route lookup to its last HTLC resolving
+    latencies = []
+    first_hop_failures = []
+    reached = []
+    probe_node = probe.probe_node
+
+    def timed_probe_node(node_id, route=None):
+        started = time.monotonic()
+        result = probe_node(node_id, route)
+        latencies.append(time.monotonic() - started)
+        if result.route and result.error.get('failcodename') == 'WIRE_TEMPORARY_CHANNEL_FAILURE' and result.error.get('erring_channel') == result.route[0]['channel']:
+            first_hop_failures.append(node_id)
+        if result.error.get('failcodename') == probe.reached_failcode:
+            reached.append(node_id)
+        return result
+    probe.probe_node = timed_probe_node
+
+    nodes = [node['nodeid'] for node in rpc.listnodes()['nodes']]
+    our_channels = probe.get_our_channels()
+    slots, in_flight_msat = probe.get_channel_limits(our_channels)
+    probe.htlc_slots = probe.HtlcSlots(slots, in_flight_msat, our_channels)
+    window = probe.get_htlc_window(args.concurrency, slots)
+    probe.rate_controller = probe.RateController(window) if args.adaptive_rate else None
+    sweep_started = time.monotonic()
+    destinations = probe.schedule_destinations(nodes, {})
+    routes = None
+    if args.plan == 'channels':
+        routes = probe.plan_channel_routes(destinations)
+        destinations = [route[-1]['id'] for route in routes]
+    probed = probe.run_probes(writer, destinations, window, set(), routes=routes)
+    writer.close()
+    sweep_seconds = time.monotonic() - sweep_started
+    channels_attributed = None
+    if not args.dsn:
+        channels_attributed = connection.execute("SELECT COUNT(DISTINCT short_channel_id) FROM hops WHERE result IS NOT NULL").fetchone()[0]
+
+    resweep = None
+    if args.update_channels and not args.replay:
+        # Gossip moves on; re-probe only what daemon_mode would
+        previous = probe.get_channel_updates()
+        rpc.update_channels(args.update_channels)
+        changed = probe.changed_channels(previous, probe.get_channel_updates())
+        if args.dsn:
+            last_results = probe.get_last_results(connection)
+        else:
+            last_results = {dest: (probed_at, failcode) for dest, probed_at, failcode in connection.execute("SELECT dest, time, failcode FROM results")}
+        destinations = probe.select_destinations(nodes, last_results, changed)
+        writer = probe.ResultWriter(connection, args.batch_size, args.flush_seconds)
+        resweep_started = time.monotonic()
+        resweep = {
+            'updated_channels': len(changed),
+            'probes': probe.run_probes(writer, probe.schedule_destinations(destinations, last_results), window, set()),
+        }
+        writer.close()
+        resweep['sweep_seconds'] = round(time.monotonic() - resweep_started, 3)
+    connection.close()
+
+    return {
+        'nodes': len(nodes),
+        'channels': len(rpc.listchannels()['channels']) // 2,
+        'concurrency': window,
+        'adaptive_rate': args.adaptive_rate,
+        'notifications': probe.settlements is not None,
+        'local_routing': args.local_routing,
+        'plan': args.plan,
+        'probes': probed,
+        'channels_attributed': channels_attributed,
+        'reached': len(reached),
+        'first_hop_failures': len(first_hop_failures),
+        'balance_first_hops': args.balance_first_hops,
+        'first_hop_probes': sorted((channel['probes'] for channel in probe.htlc_slots.utilization()), reverse=True),
+        'timeouts': sum(counter['value'] for counter in probe.metrics.snapshot()['counters'] if counter['name'] == 'probe_timeouts_total'),
+        'setup_seconds': round(setup_seconds, 3),
+        'graph_seconds': round(graph_seconds, 3),
+        'sweep_seconds': round(sweep_seconds, 3),
+        'probes_per_second': round(probed / sweep_seconds, 2) if sweep_seconds else 0,
+        'p50_probe_seconds': round(percentile(latencies, 0.5), 4),
+        'p99_probe_seconds': round(percentile(latencies, 0.99), 4),
+        'max_probe_seconds': round(max(latencies, default=0), 4),
+        'resweep': resweep,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the probing loop against a synthetic network or a recorded trace')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--channels-per-node', type=int, default=3)
+    parser.add_argument('--our-channels', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--amount-msats', type=int, default=200000000)
+    parser.add_argument('--latency-ms', type=float, default=50, help='median HTLC settle latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='lognormal spread of the settle latency')
+    parser.add_argument('--failure-rate', type=float, default=0.02, help='chance of a random failure at each hop')
+    parser.add_argument('--congestion-htlcs', type=int, default=0, help='HTLCs in flight on one of our channels beyond which it congests, 0 for never')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--plan', choices=['destinations', 'channels'], default='destinations', help='probe every node, or plan routes covering every channel')
+    parser.add_argument('--no-local-routing', dest='local_routing', action='store_false')
+    parser.add_argument('--no-balance-first-hops', dest='balance_first_hops', action='store_false', help='let routing pick the first hop instead of the least busy channel')
+    parser.add_argument('--no-failure-cache', dest='failure_cache', action='store_false')
+    parser.add_argument('--estimate-liquidity', action='store_true')
+    parser.add_argument('--notifications', action='store_true', help='settle probes from notifications, as plugin.py does, instead of waitsendpay')
+    parser.add_argument('--adaptive-rate', action='store_true', help='let the rate controller adjust concurrency')
+    parser.add_argument('--probe-timeout', type=int, default=60, help='seconds before an unresolved probe is recorded as TIMEOUT')
+    parser.add_argument('--event-log', help='write structured events to this JSON-lines file')
+    parser.add_argument('--event-level', choices=list(probe.EventLog.levels), default='info', help='lowest level written to --event-log')
+    parser.add_argument('--event-sample', type=float, default=0.01, help='fraction of per-probe debug events kept')
+    parser.add_argument('--progress-every', type=int, default=1000, help='print a progress line every this many probes, 0 for never')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--flush-seconds', type=float, default=5)
+    parser.add_argument('--sqlite', default=':memory:', help='SQLite database used when --dsn is not given')
+    parser.add_argument('--dsn', help='Postgres connection string, e.g. "dbname=bench user=postgres"')
+    parser.add_argument('--table', default='probe_bench')
+    parser.add_argument('--update-channels', type=int, default=0, help='after the sweep, update this many channels and re-probe only what changed')
+    parser.add_argument('--json', action='store_true', help='print the report as one JSON line')
+    parser.add_argument('--replay', help='serve RPC calls from a trace recorded with rpc_trace_file instead of a synthetic network')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='multiplier for recorded latencies, 0 for none')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())